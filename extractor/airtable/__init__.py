@@ -1,15 +1,31 @@
+import asyncio
+import os
+
 import pandas as pd
 import pyairtable
 import numpy as np
 from loguru import logger as log
 
-from extractor.config import AIRTABLE_PERSONAL_ACCESS_TOKEN
+from extractor.config import AIRTABLE_PERSONAL_ACCESS_TOKEN, settings
 from pyairtable import Table
 from extractor import PATH_NFE
+from extractor.airtable.mirror import AirtableMirror
+from extractor.airtable.writer import BatchWriter
+from extractor.drive.download import MANIFEST_FILE, get_download_urls
+from extractor.utils.manifest import Manifest
+from extractor.utils.normalize import BLANKABLE_FIELDS, normalize
+from extractor.utils.store import NfeStore
 
-NFE_OUTPUT_FILE = PATH_NFE / "output" / "nfe.csv"
+NFE_STORE_FILE = PATH_NFE / "output" / "nfe.sqlite"
+MIRROR_FILE = PATH_NFE / "output" / "airtable.sqlite"
 
 BASE_ID = "appuENAyrYsTpD4qj"
+REQUESTS_PER_SECOND = settings["airtable"]["requests_per_second"]
+MAX_IN_FLIGHT = settings["airtable"]["max_in_flight"]
+ENDPOINT_URL = settings["airtable"]["endpoint_url"] or "https://api.airtable.com"
+# fields Airtable matches on to update a record instead of creating a duplicate
+CHAVE_KEY = ["chave_de_acesso"]
+COMPOSITE_KEY = ["data", "valor", "num_nf"]
 
 
 def get_base(personal_token: str | None = None, base_id: None | str = None):
@@ -17,7 +33,7 @@ def get_base(personal_token: str | None = None, base_id: None | str = None):
         personal_token = AIRTABLE_PERSONAL_ACCESS_TOKEN
     if not base_id:
         base_id = BASE_ID
-    return pyairtable.Base(personal_token, base_id)
+    return pyairtable.Api(personal_token, endpoint_url=ENDPOINT_URL).base(base_id)
 
 
 def get_table(name: str) -> Table:
@@ -25,19 +41,22 @@ def get_table(name: str) -> Table:
 
 
 def retrieve_table_data(table: Table) -> pd.DataFrame:
-    records = [record for record in table.iterate()][0]
-    inner_records = [record["fields"] for record in records]
+    # iterate yields pages of up to 100 records, keep them all
+    inner_records = [record["fields"] for page in table.iterate() for record in page]
     return pd.DataFrame.from_records(inner_records)
 
 
+def sync_mirror(mirror: AirtableMirror, table_names: list[str], full: bool = False):
+    for table_name in table_names:
+        mirror.sync(table_name, get_table(table_name), full=full)
+
+
 def load_nfe_output_file(filter: bool = True):
-    df = pd.read_csv(NFE_OUTPUT_FILE)
-    if filter:
-        # filter only the maximum inserted_at (pd.Timestamp  column)
-        # let only the values with the highest inserted_at
-        maximum_inserted_at = df["inserted_at"].max()
-        log.info(f"Filtering records with inserted_at: {maximum_inserted_at}")
-        df = df.loc[df["inserted_at"] == maximum_inserted_at]
+    # filter keeps only the records of the latest run (highest inserted_at)
+    with NfeStore(str(NFE_STORE_FILE)) as store:
+        df = store.read_frame(latest_only=filter)
+    if filter and not df.empty:
+        log.info(f"Filtering records with inserted_at: {df['inserted_at'].max()}")
     return df
 
 
@@ -50,7 +69,7 @@ def format_df(df: pd.DataFrame, schema: list[str]):
     df_to_insert["obs"] = df["categoria"]
     df_to_insert["fornecedor"] = df["fornecedor_id"]
     df_to_insert["chave_de_acesso"] = df["chave_de_acesso"]
-    df_to_insert["download_url"] = df["download_url"]
+    df_to_insert["input_filepath"] = df["input_filepath"]
     df_to_insert["tabela"] = "base_despesas"
     df_to_insert["banco"] = "recdtO0RHZOmV8ld2"
     df_to_insert["estado"] = "0. Importado"
@@ -59,53 +78,116 @@ def format_df(df: pd.DataFrame, schema: list[str]):
 
 
 def make_records(df: pd.DataFrame):
-    records = []
-    for _, row in df.iterrows():
-        record = {
-            "tabela": row["tabela"],
-            "banco": [row["banco"]],
-            "estado": row["estado"],
-            "data": row["data"],
-            "fornecedor": [row["fornecedor"]],
-            "num_nf": int(row["num_nf"]) if row["num_nf"] != "" else 0,
-            "valor": row["valor"],
-            "obs": row["obs"],
-            "chave_de_acesso": row["chave_de_acesso"],
-            "nf": (
-                [{"url": row["download_url"]}]
-                if row["download_url"] not in ["", np.nan]
-                else []
-            ),
-        }
-        # Remove keys with empty or NaN values
-        record = {k: v for k, v in record.items() if v not in ["", np.nan, [""]]}
-        records.append(record)
+    records = df[["tabela", "estado", "data", "valor", "obs", "chave_de_acesso"]].copy()
+    records["banco"] = df["banco"].map(lambda banco: [banco])
+    records["fornecedor"] = df["fornecedor"].map(lambda fornecedor: [fornecedor])
+    records["num_nf"] = (
+        pd.to_numeric(df["num_nf"], errors="coerce").fillna(0).astype(int)
+    )
+    # Remove keys with empty or NaN values
+    return [
+        {k: v for k, v in record.items() if v not in ["", np.nan, [""]]}
+        for record in records.to_dict("records")
+    ]
+
+
+def normalize_incoming(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalises the whole batch at once. Invalid optional fields are left empty,
+    rows with an invalid required field are left out.
+    """
+    normalized = normalize(df)
+    frame = normalized.frame.astype(object)
+    errors = normalized.errors
+    for field in BLANKABLE_FIELDS:
+        if field in errors:
+            frame.loc[errors[field], field] = np.nan
+    invalid = normalized.invalid_required
+    for filepath, row_errors, dropped in zip(
+        df["input_filepath"], errors.to_dict("records"), invalid
+    ):
+        fields = [field for field, error in row_errors.items() if error]
+        if dropped:
+            log.warning(f"Skipping {filepath}, invalid fields: {fields}")
+        elif fields:
+            log.warning(f"Leaving invalid fields of {filepath} empty: {fields}")
+    frame = frame[~invalid]
+    return frame.where(frame.notna(), np.nan)
+
+
+def make_keys(df: pd.DataFrame) -> pd.Series:
+    """
+    Dedup key of each row: its chave de acesso, or for notes without one the
+    data, valor and num_nf normalised to text, so 1500 and "1500.00" match.
+    """
+    valor = pd.to_numeric(df["valor"], errors="coerce").map("{:.2f}".format)
+    num_nf = pd.to_numeric(df["num_nf"], errors="coerce").fillna(0).astype(int)
+    composite = "nf:" + df["data"].astype(str) + "|" + valor + "|" + num_nf.astype(str)
+    chave = df["chave_de_acesso"].astype(str)
+    return chave.where(chave != "", composite)
+
+
+def check_for_duplicates(df_to_insert: pd.DataFrame) -> pd.DataFrame:
+    """Drops repeated notes within the batch, Airtable dedups against the table."""
+    return df_to_insert[~make_keys(df_to_insert).duplicated()]
+
+
+def add_attachments(
+    records: list[dict], filepaths: list[str], manifest: Manifest
+) -> list[dict]:
+    """The NFe files as attachments, by their temporary Dropbox links."""
+    filenames = [os.path.basename(filepath) for filepath in filepaths]
+    urls = get_download_urls(manifest, list(dict.fromkeys(filenames)))
+    for record, filename in zip(records, filenames):
+        if urls.get(filename):
+            record["nf"] = [{"url": urls[filename]}]
     return records
 
 
-def check_for_duplicates(df_to_insert, existing_df):
-    # df_to_insert["data"] = pd.to_datetime(existing_df["data"])
-    # existing_df["data"] = pd.to_datetime(existing_df["data"])
-    unique_df = df_to_insert.drop_duplicates(subset=["data", "valor", "num_nf"])
-    unique_df = unique_df[
-        ~unique_df.set_index(["data", "valor", "num_nf"]).index.isin(
-            existing_df.set_index(["data", "valor", "num_nf"]).index
+def save_records(
+    df, table, table_name: str, mirror: AirtableMirror, manifest: Manifest
+):
+    """
+    Upserts on the chave de acesso, notes without one on data, valor and num_nf.
+    Rows unchanged since they were last written are skipped without a request,
+    links to the files are only generated for the others.
+    """
+    writer = BatchWriter(
+        table,
+        table_name,
+        mirror,
+        requests_per_second=REQUESTS_PER_SECOND,
+        max_in_flight=MAX_IN_FLIGHT,
+        # new temporary links every run, the file behind them is the same
+        ignore_fields=["nf"],
+    )
+    keys = make_keys(df).tolist()
+    pending = set(writer.pending(dict(zip(keys, make_records(df)))))
+    df = df[[key in pending for key in keys]]
+    keys = [key for key in keys if key in pending]
+    records = add_attachments(
+        make_records(df), df["input_filepath"].fillna("").tolist(), manifest
+    )
+    with_chave = (df["chave_de_acesso"] != "").tolist()
+    log.info(f"Saving {len(records)} records to {table_name}.")
+
+    async def write_all():
+        by_chave = {k: r for k, r, c in zip(keys, records, with_chave) if c}
+        by_composite = {k: r for k, r, c in zip(keys, records, with_chave) if not c}
+        return await writer.write(by_chave, CHAVE_KEY) + await writer.write(
+            by_composite, COMPOSITE_KEY
         )
-    ]
-    return unique_df
-
 
-def save_records(df, table):
-    records = make_records(df)
-    for record in records:
-        log.info(f"Saving record: {record}")
-        table.create(record)
+    return asyncio.run(write_all())
 
 
 if __name__ == "__main__":
     table_name = "base_geral"
     table = get_table(table_name)
-    existing_df = retrieve_table_data(table)
+    mirror = AirtableMirror(str(MIRROR_FILE))
+    manifest = Manifest(MANIFEST_FILE)
+    # only the records changed since the last run are downloaded
+    sync_mirror(mirror, ["cadastro_fornecedores"])
     schema = [
         "data",
         "num_nf",
@@ -118,10 +200,9 @@ if __name__ == "__main__":
         "fornecedor",
     ]
 
-    incoming_df = load_nfe_output_file()
+    incoming_df = normalize_incoming(load_nfe_output_file())
     # Match the CNPJ field in fornecedor_df with cnpj_do_vendedor from incoming_df and from there get the Record field from fornecedor_df
-    fornecedor_table = get_table("cadastro_fornecedores")
-    fornecedor_df = retrieve_table_data(fornecedor_table)
+    fornecedor_df = mirror.read_frame("cadastro_fornecedores", ["CNPJ", "record"])
     fornecedor_df.rename(columns={"CNPJ": "cnpj_do_vendedor"}, inplace=True)
     incoming_df = pd.merge(
         incoming_df,
@@ -131,6 +212,8 @@ if __name__ == "__main__":
     ).rename(columns={"record": "fornecedor_id"})
 
     incoming_df = format_df(incoming_df, schema)
-    incoming_df = check_for_duplicates(incoming_df, existing_df)
+    incoming_df = check_for_duplicates(incoming_df)
 
-    save_records(incoming_df, table)
+    save_records(incoming_df, table, table_name, mirror, manifest)
+    mirror.close()
+    manifest.close()
@@ -0,0 +1,162 @@
+"""Local SQLite mirror of Airtable tables, refreshed incrementally"""
+
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List
+
+import pandas as pd
+from loguru import logger as log
+from pyairtable import Table
+
+# re-read records modified just before the last sync, clocks are never in sync
+SYNC_OVERLAP = timedelta(minutes=5)
+
+
+class AirtableMirror:
+    """
+    One row per Airtable record, its fields kept as JSON. `sync` only downloads
+    the records modified since the previous sync and writes them page by page, so
+    its cost follows the changes rather than the size of the table. Deletions are
+    only seen by a `full` sync.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._conn = sqlite3.connect(filepath)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "table_name TEXT NOT NULL, id TEXT NOT NULL, created_time TEXT, "
+            "fields TEXT NOT NULL, PRIMARY KEY (table_name, id))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS syncs ("
+            "table_name TEXT PRIMARY KEY, synced_at TEXT NOT NULL)"
+        )
+        # the records we wrote, by their dedup key, with a hash of the fields sent
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS written ("
+            "table_name TEXT NOT NULL, key TEXT NOT NULL, hash TEXT NOT NULL, "
+            "id TEXT NOT NULL, PRIMARY KEY (table_name, key))"
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def last_synced(self, table_name: str) -> datetime | None:
+        row = self._conn.execute(
+            "SELECT synced_at FROM syncs WHERE table_name = ?", (table_name,)
+        ).fetchone()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def sync(self, table_name: str, table: Table, full: bool = False) -> int:
+        """Downloads the records changed since the last sync, all on the first one."""
+        started_at = datetime.now(timezone.utc)
+        last_synced = None if full else self.last_synced(table_name)
+        options: Dict[str, Any] = {"page_size": 100}
+        if last_synced is not None:
+            since = (last_synced - SYNC_OVERLAP).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+            options[
+                "formula"
+            ] = f"IS_AFTER(LAST_MODIFIED_TIME(), DATETIME_PARSE('{since}'))"
+
+        count = 0
+        with self._conn:
+            if full or last_synced is None:
+                self._conn.execute(
+                    "DELETE FROM records WHERE table_name = ?", (table_name,)
+                )
+            for page in table.iterate(**options):
+                self._upsert(table_name, page)
+                count += len(page)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO syncs (table_name, synced_at) VALUES (?, ?)",
+                (table_name, started_at.isoformat()),
+            )
+        kind = "incremental" if last_synced else "full"
+        log.info(f"Mirrored {count} records of {table_name} ({kind} sync).")
+        return count
+
+    def upsert(self, table_name: str, records: List[Dict[str, Any]]):
+        """Keeps records written by us in the mirror without waiting for a sync."""
+        with self._conn:
+            self._upsert(table_name, records)
+
+    def _upsert(self, table_name: str, records: List[Dict[str, Any]]):
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO records (table_name, id, created_time, fields) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (
+                    table_name,
+                    record["id"],
+                    record.get("createdTime"),
+                    json.dumps(record["fields"], ensure_ascii=False),
+                )
+                for record in records
+            ],
+        )
+
+    def written_hashes(self, table_name: str) -> Dict[str, str]:
+        cursor = self._conn.execute(
+            "SELECT key, hash FROM written WHERE table_name = ?", (table_name,)
+        )
+        return dict(cursor.fetchall())
+
+    def mark_written(
+        self,
+        table_name: str,
+        keys: List[str],
+        hashes: List[str],
+        records: List[Dict[str, Any]],
+    ):
+        """Checkpoints a written batch and mirrors the records Airtable returned."""
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO written (table_name, key, hash, id) "
+                "VALUES (?, ?, ?, ?)",
+                [
+                    (table_name, key, digest, record["id"])
+                    for key, digest, record in zip(keys, hashes, records)
+                ],
+            )
+            self._upsert(table_name, records)
+
+    def iter_records(self, table_name: str) -> Iterator[Dict[str, Any]]:
+        """Fields of every mirrored record, plus its `id`, one at a time."""
+        cursor = self._conn.execute(
+            "SELECT id, fields FROM records WHERE table_name = ?", (table_name,)
+        )
+        for record_id, fields in cursor:
+            yield {**json.loads(fields), "id": record_id}
+
+    def read_frame(
+        self, table_name: str, fields: List[str] | None = None
+    ) -> pd.DataFrame:
+        """
+        The mirrored table as a DataFrame, only `fields` are extracted when given,
+        inside SQLite, so the other columns are never parsed.
+        """
+        if fields is None:
+            return pd.DataFrame.from_records(list(self.iter_records(table_name)))
+        columns = ", ".join(
+            f'json_extract(fields, \'$."{field}"\') AS "{field}"' for field in fields
+        )
+        return pd.read_sql_query(
+            f"SELECT {columns} FROM records WHERE table_name = ?",
+            self._conn,
+            params=(table_name,),
+        )
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
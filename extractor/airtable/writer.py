@@ -0,0 +1,114 @@
+"""Batched, rate limited and resumable upserts of records to an Airtable table"""
+
+import asyncio
+import json
+from typing import Any, Dict, Iterable, List
+
+from loguru import logger as log
+from pyairtable import Table
+
+from extractor.airtable.mirror import AirtableMirror
+from extractor.utils.cache import make_key
+from extractor.utils.scheduler import RateLimiter
+
+BATCH_SIZE = 10  # records per request, the Airtable maximum
+
+
+def record_hash(record: Dict[str, Any], ignore_fields: Iterable[str] = ()) -> str:
+    fields = {
+        name: value for name, value in record.items() if name not in ignore_fields
+    }
+    return make_key(json.dumps(fields, sort_keys=True, default=str))
+
+
+class BatchWriter:
+    """
+    Upserts records 10 per request, with up to `max_in_flight` requests running
+    and at most `requests_per_second` started per second. Each record comes with
+    a dedup key: records already written under that key with the same fields are
+    skipped before any request, the others are upserted so that Airtable updates
+    the record matching on the merge fields instead of creating a duplicate.
+    Every batch written is checkpointed in the mirror, so a failed run resumes
+    where it stopped. `ignore_fields` change on every run without changing the
+    record, e.g. temporary links, and are left out of the comparison.
+    """
+
+    def __init__(
+        self,
+        table: Table,
+        table_name: str,
+        mirror: AirtableMirror,
+        requests_per_second: float = 5,
+        max_in_flight: int = 4,
+        ignore_fields: Iterable[str] = (),
+    ):
+        self.table = table
+        self.table_name = table_name
+        self.mirror = mirror
+        self.requests_per_second = requests_per_second
+        self.max_in_flight = max_in_flight
+        self.ignore_fields = set(ignore_fields)
+
+    def hashes(self, records: Dict[str, Dict[str, Any]]) -> Dict[str, str]:
+        return {
+            key: record_hash(record, self.ignore_fields)
+            for key, record in records.items()
+        }
+
+    def pending(
+        self,
+        records: Dict[str, Dict[str, Any]],
+        hashes: Dict[str, str] | None = None,
+    ) -> List[str]:
+        """Keys of the records not written yet, or changed since they were."""
+        if hashes is None:
+            hashes = self.hashes(records)
+        written = self.mirror.written_hashes(self.table_name)
+        return [key for key in records if written.get(key) != hashes[key]]
+
+    async def write(
+        self, records: Dict[str, Dict[str, Any]], merge_on: List[str]
+    ) -> int:
+        """
+        Upserts `records`, a dict of dedup key to fields, matching on the
+        `merge_on` fields. Returns how many records were created or updated.
+        """
+        hashes = self.hashes(records)
+        keys = self.pending(records, hashes)
+        if len(keys) < len(records):
+            log.info(f"Skipping {len(records) - len(keys)} records already written.")
+
+        batches = [keys[i : i + BATCH_SIZE] for i in range(0, len(keys), BATCH_SIZE)]
+        limiter = RateLimiter(
+            self.requests_per_second * 60, headroom=1, burst=self.requests_per_second
+        )
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+
+        async def send(batch: List[str]) -> int:
+            async with in_flight:
+                await limiter.acquire()
+                result = await asyncio.to_thread(
+                    self.table.batch_upsert,
+                    [{"fields": records[key]} for key in batch],
+                    key_fields=merge_on,
+                )
+            self.mirror.mark_written(
+                self.table_name,
+                batch,
+                [hashes[key] for key in batch],
+                result["records"],
+            )
+            return len(result["records"])
+
+        results = await asyncio.gather(
+            *(send(batch) for batch in batches), return_exceptions=True
+        )
+        failures = [result for result in results if isinstance(result, Exception)]
+        for failure in failures:
+            log.error(f"Failed to write a batch to {self.table_name}: {failure}")
+        upserted = sum(result for result in results if isinstance(result, int))
+        log.info(
+            f"Upserted {upserted} records in {self.table_name} on {merge_on}, "
+            f"{len(failures)} of {len(batches)} batches failed."
+        )
+        return upserted
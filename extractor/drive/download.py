@@ -1,12 +1,27 @@
-import dropbox
+import json
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+import dropbox
+from loguru import logger as log
 
-from extractor.config import DROPBOX_ACCESS_TOKEN
+from extractor.config import DROPBOX_ACCESS_TOKEN, ROOT_PATH, settings
 from extractor import PATH_DRIVE, PATH_NFE
+from extractor.utils import get_path
+from extractor.utils.manifest import Manifest
 
 DOWNLOADED_CACHE = PATH_DRIVE / "cache" / ".downloaded_files"
+CURSORS_FILE = PATH_DRIVE / "cache" / "cursors.json"
 INPUT_FOLDER = PATH_NFE / "input"
-OUTPUT_FOLDER = PATH_NFE / "output"
+MANIFEST_FILE = get_path(ROOT_PATH, settings["filepaths"]["manifest"])
+
+FOLDER_PATH = settings["drive"]["folder_path"]
+MAX_WORKERS = settings["drive"]["max_workers"]
+CHUNK_SIZE = settings["drive"]["chunk_size_kb"] * 1024
+LINK_TTL_SEC = 4 * 60 * 60  # Dropbox temporary links expire after 4 hours
+LINK_MARGIN_SEC = settings["drive"]["link_margin_sec"]
 
 
 def connect_to_dropbox(access_token: str | None = None) -> dropbox.Dropbox:
@@ -15,58 +30,174 @@ def connect_to_dropbox(access_token: str | None = None) -> dropbox.Dropbox:
     return dropbox.Dropbox(access_token)
 
 
-def get_downloaded_files() -> set[str]:
+def import_downloaded_cache(manifest: Manifest):
+    """Moves the hashes of the `.downloaded_files` cache into the manifest, once."""
     if not os.path.exists(DOWNLOADED_CACHE):
-        return set()
+        return
     with open(DOWNLOADED_CACHE, "r") as file:
-        return set(file.read().splitlines())
-
+        hashes = set(file.read().splitlines())
+    manifest.import_downloaded(hashes)
+    os.replace(DOWNLOADED_CACHE, f"{DOWNLOADED_CACHE}.imported")
+    log.info(f"Imported {len(hashes)} downloaded files into the manifest.")
 
-def add_to_downloaded_files(file_name: str):
-    with open(DOWNLOADED_CACHE, "a") as file:
-        file.write(f"{file_name}\n")
 
+def load_cursors() -> dict[str, str]:
+    if not os.path.exists(CURSORS_FILE):
+        return {}
+    with open(CURSORS_FILE) as f:
+        return json.load(f)
 
-def download_file(dbx, file_metadata):
-    with open(INPUT_FOLDER / file_metadata.name, "wb") as file:
-        metadata, res = dbx.files_download(path=file_metadata.path_lower)
-        file.write(res.content)
-    add_to_downloaded_files(file_metadata.content_hash)
-
-
-def save_download_urls(filename, download_url):
-    file_path = OUTPUT_FOLDER / "download_urls.csv"
 
-    # Check if file exists and is empty
-    file_exists = os.path.exists(file_path)
-    is_empty = not os.path.getsize(file_path) if file_exists else True
+def save_cursor(folder_path: str, cursor: str):
+    """Written to a temporary file and renamed, a crash never leaves half a file."""
+    cursors = {**load_cursors(), folder_path: cursor}
+    tmp_path = f"{CURSORS_FILE}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cursors, f, indent=2)
+    os.replace(tmp_path, CURSORS_FILE)
 
-    with open(file_path, "a") as file:
-        if is_empty:
-            file.write("filename,download_url\n")  # Write column names
-        file.write(f"{filename},{download_url}\n")
 
-
-def get_files_list(dbx, folder_path: str):
-    downloaded_files = get_downloaded_files()
+def download_file(dbx, file_metadata):
+    """Streams the file to a temporary name in chunks and renames it when complete."""
+    log.info(f"Downloading: {file_metadata.name}")
+    filepath = INPUT_FOLDER / file_metadata.name
+    tmp_path = INPUT_FOLDER / f".{file_metadata.name}.part"
+    metadata, res = dbx.files_download(path=file_metadata.path_lower)
     try:
-        files = dbx.files_list_folder(folder_path).entries
-        for file in files:
-            if isinstance(file, dropbox.files.FileMetadata):
-                if file.content_hash not in downloaded_files:
-                    save_download_urls(
-                        file.name.split("/")[-1],
-                        dbx.files_get_temporary_link(file.path_lower).link,
-                    )
-                    print(f"Downloading: {file.name}")
-                    download_file(dbx, file)
-                else:
-                    print(f"Skipping: {file.name}, already downloaded")
-    except Exception as e:
-        print(f"Error: {e}")
+        with open(tmp_path, "wb") as file:
+            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                file.write(chunk)
+        os.replace(tmp_path, filepath)
+    finally:
+        res.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def get_download_urls(
+    manifest: Manifest, filenames: List[str], dbx=None, max_workers: int = MAX_WORKERS
+) -> Dict[str, str]:
+    """
+    Temporary links of the downloaded `filenames`, only generated for those
+    without a cached link valid for a while longer, concurrently. Files
+    downloaded before the manifest kept their Dropbox path are looked up as
+    `FOLDER_PATH/<filename>`, and that path is recorded once it has a link.
+    """
+    known = manifest.links([str(INPUT_FOLDER / filename) for filename in filenames])
+    urls: Dict[str, str] = {}
+    missing = []
+    backfilled = set()
+    expires_soon = time.time() + LINK_MARGIN_SEC
+    for filename in filenames:
+        link = known.get(os.path.abspath(INPUT_FOLDER / filename))
+        if link is None or link.dropbox_path is None:
+            missing.append((filename, f"{FOLDER_PATH.rstrip('/')}/{filename}"))
+            backfilled.add(filename)
+        elif link.link and link.expires_at > expires_soon:
+            urls[filename] = link.link
+        else:
+            missing.append((filename, link.dropbox_path))
+    if not missing:
+        return urls
+
+    log.info(f"Generating {len(missing)} temporary links, {len(urls)} cached.")
+    dbx = dbx or connect_to_dropbox()
+    fetched = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(dbx.files_get_temporary_link, dropbox_path): filename
+            for filename, dropbox_path in missing
+        }
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                urls[filename] = future.result().link
+            except Exception as e:
+                log.error(f"Error getting a link for {filename}: {e}")
+                continue
+            # counted from the request, the link was created a moment later
+            expires_at = time.time() - 60 + LINK_TTL_SEC
+            fetched.append((str(INPUT_FOLDER / filename), urls[filename], expires_at))
+    manifest.backfill_dropbox_paths(
+        (str(INPUT_FOLDER / filename), dropbox_path)
+        for filename, dropbox_path in missing
+        if filename in backfilled and filename in urls
+    )
+    manifest.set_links(fetched)
+    return urls
+
+
+def list_changes(dbx, folder_path: str, cursor: str | None) -> Tuple[List, str]:
+    """
+    Entries added or changed since `cursor`, every entry when there is none or
+    Dropbox reset it. Follows `has_more` through all the pages.
+    """
+    result = None
+    if cursor:
+        try:
+            result = dbx.files_list_folder_continue(cursor)
+        except dropbox.exceptions.ApiError as e:
+            if not (
+                isinstance(e.error, dropbox.files.ListFolderContinueError)
+                and e.error.is_reset()
+            ):
+                raise
+            log.warning(f"Cursor of {folder_path} was reset, listing it again.")
+    if result is None:
+        result = dbx.files_list_folder(folder_path)
+
+    entries = list(result.entries)
+    while result.has_more:
+        result = dbx.files_list_folder_continue(result.cursor)
+        entries.extend(result.entries)
+    return entries, result.cursor
+
+
+def get_files_list(
+    dbx, folder_path: str, manifest: Manifest, max_workers: int = MAX_WORKERS
+) -> int:
+    """
+    Downloads the files added to `folder_path` since the last sync. The cursor is
+    only saved once every download succeeded, so failed files are listed again
+    on the next run. Returns how many files were downloaded.
+    """
+    os.makedirs(CURSORS_FILE.parent, exist_ok=True)
+    os.makedirs(INPUT_FOLDER, exist_ok=True)
+    entries, cursor = list_changes(dbx, folder_path, load_cursors().get(folder_path))
+
+    files = [
+        entry
+        for entry in entries
+        if isinstance(entry, dropbox.files.FileMetadata)
+        and not manifest.is_downloaded(entry.content_hash)
+    ]
+    log.info(f"Listed {len(entries)} changed entries, {len(files)} files to download.")
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(download_file, dbx, file): file for file in files}
+        for future in as_completed(futures):
+            file = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                failures += 1
+                log.error(f"Error downloading {file.name}: {e}")
+                continue
+            # the manifest is only written from this thread
+            manifest.mark_downloaded(
+                str(INPUT_FOLDER / file.name), file.path_lower, file.content_hash
+            )
+
+    if failures:
+        log.warning(f"{failures} downloads failed, keeping the previous cursor.")
+    else:
+        save_cursor(folder_path, cursor)
+    return len(files) - failures
 
 
 if __name__ == "__main__":
-    folder_path = "/01. Adm/Adm. 2015/BANCOS 15/notas_fiscais"
     dbx = connect_to_dropbox()
-    get_files_list(dbx, folder_path)
+    with Manifest(MANIFEST_FILE) as manifest:
+        import_downloaded_cache(manifest)
+        get_files_list(dbx, FOLDER_PATH, manifest)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
 import os
 import glob
 from functools import partial
-from typing import List
+from typing import AsyncIterator, List, NamedTuple, Tuple
 from multiprocessing import Pool
+from multiprocessing.pool import Pool as ProcessPool
+import fitz
 from tqdm import tqdm
 from loguru import logger as log
 
@@ -31,6 +35,18 @@ import extractor.utils as utils
 persist_directory = os.environ.get("PERSIST_DIRECTORY", "db")
 source_directory = os.environ.get("SOURCE_DIRECTORY", "source_documents")
 
+IN_PROCESS_MAX_FILES = settings["loader"]["in_process_max_files"]
+PAGE_SEPARATOR = "\f"  # form feed, whitespace to the prompt and the patterns
+
+_POOL: ProcessPool | None = None
+
+
+class LoadedDocument(NamedTuple):
+    """What workers send back, cheaper to pickle than a langchain `Document`."""
+
+    source: str
+    page_content: str
+
 
 # Custom document loaders
 class MyElmLoader(UnstructuredEmailLoader):
@@ -112,23 +128,152 @@ def load_single_document(
     raise ValueError(f"Unsupported file extension '{ext}'")
 
 
-def run(files: List[Document], keep_first_page_only: bool = False) -> List[Document]:
+def load_pdf(
+    file_path: str, first_page: int = 0, last_page: int | None = None
+) -> LoadedDocument:
+    """
+    Extracts the text of pages [first_page, last_page) straight from PyMuPDF, only
+    the selected pages are parsed and no per page `Document` is built on the way.
+    Pages are joined by `PAGE_SEPARATOR` so they can be told apart later.
+    """
+    with fitz.open(file_path) as pdf:
+        last_page = min(last_page or pdf.page_count, pdf.page_count)
+        page_content = PAGE_SEPARATOR.join(
+            pdf[number].get_text() for number in range(first_page, last_page)
+        )
+    return LoadedDocument(file_path, page_content)
+
+
+def load_file(
+    file_path: str, keep_first_page_only: bool = False
+) -> List[LoadedDocument]:
+    if file_path.lower().endswith(".pdf"):
+        return [load_pdf(file_path, last_page=1 if keep_first_page_only else None)]
+    return [
+        LoadedDocument(document.metadata["source"], document.page_content)
+        for document in load_single_document(file_path, keep_first_page_only)
+    ]
+
+
+def get_pool() -> ProcessPool:
+    """Process pool created on first use and reused by every later call."""
+    global _POOL
+    if _POOL is None:
+        _POOL = Pool(processes=os.cpu_count())
+        atexit.register(close_pool)
+    return _POOL
+
+
+def close_pool():
+    global _POOL
+    if _POOL is not None:
+        _POOL.close()
+        _POOL.join()
+        _POOL = None
+
+
+def get_chunksize(num_files: int) -> int:
+    # Same heuristic as Pool.map, about four chunks per worker
+    return max(1, num_files // ((os.cpu_count() or 1) * 4))
+
+
+def run(files: List[str], keep_first_page_only: bool = False) -> List[LoadedDocument]:
     """
     Loads all documents from the source documents directory, preserving the order of files.
+    Small batches are loaded in process, since starting workers would cost more.
     """
-    with Pool(processes=os.cpu_count()) as pool:
-        results = []
-        loader_with_flag = partial(
-            load_single_document, keep_first_page_only=keep_first_page_only
+    results = []
+    loader_with_flag = partial(load_file, keep_first_page_only=keep_first_page_only)
+    if len(files) <= IN_PROCESS_MAX_FILES:
+        loaded = map(loader_with_flag, files)
+    else:
+        loaded = get_pool().imap(
+            loader_with_flag, files, chunksize=get_chunksize(len(files))
         )
-        with tqdm(total=len(files), desc="Loading new documents", ncols=80) as pbar:
-            for docs in pool.imap(loader_with_flag, files):  # type: ignore
-                results.extend(docs)
-                pbar.update()
+    with tqdm(total=len(files), desc="Loading new documents", ncols=80) as pbar:
+        for docs in loaded:
+            results.extend(docs)
+            pbar.update()
 
     return results
 
 
+def load_chunk(
+    file_paths: List[str], keep_first_page_only: bool = False
+) -> List[Tuple[str, List[LoadedDocument] | Exception]]:
+    """Loads several files in one worker task, a failure only affects its own file."""
+    results: List[Tuple[str, List[LoadedDocument] | Exception]] = []
+    for file_path in file_paths:
+        try:
+            results.append((file_path, load_file(file_path, keep_first_page_only)))
+        except Exception as e:
+            results.append((file_path, e))
+    return results
+
+
+async def stream(
+    files: List[str], keep_first_page_only: bool = False, queue_size: int = 32
+) -> AsyncIterator[LoadedDocument]:
+    """
+    Yields documents as soon as each one is parsed, in completion order. At most
+    `queue_size` files are being parsed or waiting to be consumed at any time, so
+    memory stays bounded and the consumer can overlap its own work with parsing.
+    Small batches are loaded in a thread, since starting workers would cost more,
+    larger ones are sent to the pool in chunks.
+    """
+    if len(files) <= IN_PROCESS_MAX_FILES:
+        for file_path in files:
+            try:
+                result = await asyncio.to_thread(
+                    load_file, file_path, keep_first_page_only
+                )
+            except Exception as e:
+                log.error(f"Failed to load {file_path}: {e}")
+                continue
+            for document in result:
+                yield document
+        return
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    slots = asyncio.Semaphore(queue_size)
+    chunksize = min(get_chunksize(len(files)), queue_size)
+    load_with_flag = partial(load_chunk, keep_first_page_only=keep_first_page_only)
+
+    def put_results(results):
+        for file_path, result in results:
+            loop.call_soon_threadsafe(queue.put_nowait, (file_path, result))
+
+    def put_error(chunk, error):
+        put_results([(file_path, error) for file_path in chunk])
+
+    async def submit():
+        pool = get_pool()
+        for start in range(0, len(files), chunksize):
+            chunk = files[start : start + chunksize]
+            for _ in chunk:
+                await slots.acquire()
+            pool.apply_async(
+                load_with_flag,
+                (chunk,),
+                callback=put_results,
+                error_callback=partial(put_error, chunk),
+            )
+
+    producer = asyncio.create_task(submit())
+    try:
+        for _ in range(len(files)):
+            file_path, result = await queue.get()
+            slots.release()
+            if isinstance(result, BaseException):
+                log.error(f"Failed to load {file_path}: {result}")
+                continue
+            for document in result:
+                yield document
+    finally:
+        producer.cancel()
+
+
 if __name__ == "__main__":
     NFES_INPUT = utils.get_files(ROOT_PATH, settings["filepaths"]["nfe_input"])
 
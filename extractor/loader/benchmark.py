@@ -0,0 +1,66 @@
+"""Benchmark of the PyMuPDF fast path against langchain's PyMuPDFLoader
+
+Usage: python extractor/loader/benchmark.py [pdf directory] [repeat]
+"""
+
+import statistics
+import sys
+import time
+from typing import Callable, List
+
+import fitz
+
+from extractor.config import ROOT_PATH, settings
+import extractor.utils as utils
+from extractor.loader import get_files, load_pdf, load_single_document
+
+
+def get_multi_page_pdfs(source_dir: str) -> List[str]:
+    files = [file for file in get_files(source_dir) if file.lower().endswith(".pdf")]
+    multi_page = []
+    for file_path in files:
+        with fitz.open(file_path) as pdf:
+            if pdf.page_count > 1:
+                multi_page.append(file_path)
+    return multi_page
+
+
+def timeit(fn: Callable, files: List[str], repeat: int) -> List[float]:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for file_path in files:
+            fn(file_path)
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def report(label: str, durations: List[float], num_files: int):
+    median = statistics.median(durations)
+    print(
+        f"{label:<32} median={median:.3f}s "
+        f"per_file={median / num_files * 1000:.2f}ms min={min(durations):.3f}s"
+    )
+
+
+if __name__ == "__main__":
+    source_dir = (
+        sys.argv[1]
+        if len(sys.argv) > 1
+        else utils.get_path(ROOT_PATH, settings["filepaths"]["nfe_input"])
+    )
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    files = get_multi_page_pdfs(source_dir)
+    if not files:
+        sys.exit(f"No multi page PDFs found in {source_dir}")
+    print(f"Benchmarking {len(files)} multi page PDFs, {repeat} rounds each")
+
+    cases = {
+        "langchain PyMuPDFLoader": load_single_document,
+        "fitz all pages": load_pdf,
+        "langchain first page only": lambda f: load_single_document(f, True),
+        "fitz first page only": lambda f: load_pdf(f, last_page=1),
+    }
+    for label, fn in cases.items():
+        report(label, timeit(fn, files, repeat), len(files))
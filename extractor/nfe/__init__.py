@@ -1,28 +1,78 @@
 import asyncio
+import contextlib
+import functools
+import json
 from loguru import logger as log
 import os
+import re
+import time
 import pandas as pd
-from pydantic import Field
+import xml.etree.ElementTree as ET
+from pydantic import Field, TypeAdapter, ValidationError, create_model
+from pydantic.fields import FieldInfo
 from instructor import OpenAISchema
-from typing import Optional
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    get_args,
+)
 
 
 from extractor.config import settings, ROOT_PATH
 import extractor.utils as utils
 from extractor.utils import llm
+from extractor.utils.cache import ExtractionCache, make_key
+from extractor.utils.manifest import PROCESSED, Manifest
+from extractor.utils.scheduler import Scheduler
+from extractor.utils.store import NfeStore
+from extractor.utils.streaming import ObjectStreamParser
+from extractor.utils.tokens import acount_tokens_batch, count_tokens
+from extractor.loader import PAGE_SEPARATOR
+from extractor.nfe import patterns, xml_parser, chunking
 
 TIMEOUT_RETRIES = settings["llm"]["timeout_retries"]
 TIMEOUT_SEC = settings["llm"]["timeout_sec"]
+MAX_WORKERS = settings["llm"]["max_workers"]
+REQUESTS_PER_MINUTE = settings["llm"]["requests_per_minute"]
+TOKENS_PER_MINUTE = settings["llm"]["tokens_per_minute"]
+RATE_LIMIT_HEADROOM = settings["llm"]["rate_limit_headroom"]
+COMPLETION_TOKENS = settings["llm"]["completion_tokens"]
+RUN_DEADLINE_SEC = settings["llm"]["run_deadline_sec"]
+LONG_DOCUMENT_TOKENS = settings["llm"]["long_document_tokens"]
+CHUNK_TOKENS = settings["llm"]["chunk_tokens"]
+MAX_CHUNKS = settings["llm"]["max_chunks"]
+MAX_INVALID_FIELDS = settings["llm"]["max_invalid_fields"]
+PACK_MAX_TOKENS = settings["llm"]["pack_max_tokens"]
+PACK_MAX_DOCUMENTS = settings["llm"]["pack_max_documents"]
+# prompts counted per thread hop, tiktoken encodes them in parallel
+COUNT_BATCH_SIZE = 16
+QUEUE_SIZE = settings["loader"]["queue_size"]
 
 NFES_FILES = utils.get_files(ROOT_PATH, settings["filepaths"]["nfe_input"])
 NFES_INPUT = utils.get_path(ROOT_PATH, settings["filepaths"]["nfe_input"])
 NFES_OUTPUT = utils.get_path(ROOT_PATH, settings["filepaths"]["nfe_output"])
+NFES_STORE = utils.get_path(ROOT_PATH, settings["filepaths"]["nfe_store"])
+MANIFEST_FILE = utils.get_path(ROOT_PATH, settings["filepaths"]["manifest"])
+# the processed files index the manifest replaced, imported on the first run
+LEGACY_INDEX = utils.get_path(ROOT_PATH, ["nfe", "output", "processed.sqlite"])
+
+EXTRACTION_CACHE = ExtractionCache(
+    utils.get_path(ROOT_PATH, settings["cache"]["dirpath"]),
+    max_size_mb=settings["cache"]["max_size_mb"],
+    max_age_days=settings["cache"]["max_age_days"],
+)
 
 
 class NfeCampos(OpenAISchema):
     data: str = Field(
         ...,
-        description="data_para_pagamento o formato no documento é dd/mm/aaaa, porém escreva ele no formato aaaa-mm-dd, se houver diversas, coloque em formato de lista [dd/mm/aaaa, dd/mm/aaaa], se não houve essa informação replique a data_de_emissão",
+        description="data_para_pagamento o formato no documento é dd/mm/aaaa, porém escreva ele no formato aaaa-mm-dd, se houver diversas, coloque em formato de lista [aaaa-mm-dd, aaaa-mm-dd], se não houve essa informação replique a data_de_emissão",
     )
     categoria: str = Field(
         ...,
@@ -137,83 +187,753 @@ class NfeCampos(OpenAISchema):
 #     )
 
 
-async def process_nfe_document(
-    document: str, input_filepath: str, temperature: float = 0.1, **kwargs
-) -> None | NfeCampos:
-    """
-    Process an NFE document by calling the OpenAI API with a specified timeout and retries.
-    Returns NfeCampos model or None if failed after retries.
-    """
-    system_prompt = (
-        "Você e um leitor de documentos de notas fiscais brasileiras. "
-        "Sua funçao e somente retornar os valores respectivos das chaves especificadas. "
-        "Caso algum valor nao exista na nota deixe o campo vazio. "
+NULLABLE_FIELDS = {
+    name
+    for name, field in NfeCampos.model_fields.items()
+    if type(None) in get_args(field.annotation)
+}
+
+
+class NfeLote(OpenAISchema):
+    notas: List[NfeCampos] = Field(
+        ...,
+        description="uma entrada para cada nota fiscal enviada, cada uma com o seu input_filepath",
     )
-    user_prompt = (
+
+
+SYSTEM_PROMPT = (
+    "Você e um leitor de documentos de notas fiscais brasileiras. "
+    "Sua funçao e somente retornar os valores respectivos das chaves especificadas. "
+    "Caso algum valor nao exista na nota deixe o campo vazio. "
+)
+
+
+def make_user_prompt(document: str, input_filepath: str) -> str:
+    return (
         f"Adicione esse campo tambem: input_filepath: {input_filepath} "
         f"Segue a nota fiscal: \n{document}"
     )
 
-    full_prompt = (
-        utils.get_string_from_basemodel(NfeCampos) + system_prompt + user_prompt
+
+@functools.lru_cache
+def count_prompt_overhead(schema: Type[OpenAISchema]) -> int:
+    """Tokens of the function schema and the system prompt, equal for every document."""
+    prompt = json.dumps(schema.openai_schema, ensure_ascii=False) + SYSTEM_PROMPT
+    return count_tokens(prompt, llm.DEFAULT_MODEL)
+
+
+def extraction_cache_key(
+    document: str, model: str, schema: Type[OpenAISchema] = NfeCampos
+) -> str:
+    """Everything that changes the answer, except the filepath of the document."""
+    function = json.dumps(schema.openai_schema, sort_keys=True)
+    prompt = SYSTEM_PROMPT + make_user_prompt("", "")
+    return make_key(document, function, prompt, model)
+
+
+@functools.lru_cache
+def make_partial_schema(fields: Tuple[str, ...]) -> Type[OpenAISchema]:
+    """NfeCampos restricted to `fields`, so the model is only asked for those."""
+    return create_model(
+        "NfeCampos",
+        __base__=OpenAISchema,
+        **{
+            name: (
+                NfeCampos.model_fields[name].annotation,
+                NfeCampos.model_fields[name],
+            )
+            for name in fields
+        },
     )
 
-    model = llm.chose_cheapest_model_given_limit(full_prompt)
 
+@functools.lru_cache
+def make_pack_schema(fields: Tuple[str, ...]) -> Type[OpenAISchema]:
+    """NfeLote of notas restricted to `fields`."""
+    if fields == tuple(NfeCampos.model_fields):
+        return NfeLote
+    return create_model(
+        "NfeLote",
+        __base__=OpenAISchema,
+        notas=(List[make_partial_schema(fields)], NfeLote.model_fields["notas"]),
+    )
+
+
+@functools.lru_cache
+def make_chunk_schema(fields: Tuple[str, ...]) -> Type[OpenAISchema]:
+    """Like `make_partial_schema` with every field optional, a chunk may lack any."""
+    return create_model(
+        "NfeCampos",
+        __base__=OpenAISchema,
+        **{
+            name: (
+                Optional[NfeCampos.model_fields[name].annotation],
+                FieldInfo.merge_field_infos(NfeCampos.model_fields[name], default=None),
+            )
+            for name in fields
+        },
+    )
+
+
+def get_schema(known_fields: Dict[str, Any]) -> Type[OpenAISchema] | None:
+    """Schema of what is left to ask the model for, None when nothing is."""
+    missing = tuple(name for name in NfeCampos.model_fields if name not in known_fields)
+    if not missing:
+        return None
+    return make_partial_schema(missing) if len(known_fields) > 1 else NfeCampos
+
+
+def lookup_extraction(
+    document: str, schema: Type[OpenAISchema], models: List[str]
+) -> Dict[str, Any] | None:
+    """Cached answer of any of `models` for `document` asked with `schema`."""
+    for model in models:
+        if cached := EXTRACTION_CACHE.get(
+            extraction_cache_key(document, model, schema)
+        ):
+            return cached
+
+
+def prepare_xml_document(document: str) -> Tuple[str, Dict[str, Any]]:
+    """
+    Reads the tagged fields of an XML locally. When the layout is one we map, its
+    number or chave was read, the nullable fields it lacks are empty. Otherwise
+    the model is asked for them. When only `categoria` is left for the model, it
+    gets the item descriptions instead of the whole XML.
+    """
+    try:
+        extraction = xml_parser.parse_xml(document)
+    except ET.ParseError as e:
+        log.warning(f"Could not parse XML, sending it as text: {e}")
+        return document, {}
+    fields = extraction.fields
+    if {"num_nf", "chave_de_acesso"} & fields.keys():
+        fields = {**dict.fromkeys(NULLABLE_FIELDS), **fields}
+    missing = set(NfeCampos.model_fields).difference(fields, {"input_filepath"})
+    if missing <= {"categoria"} and extraction.descriptions:
+        document = "\n".join(extraction.descriptions)
+    return document, fields
+
+
+def validate_data(v: str) -> str:
+    """A date, or the list of due dates `[aaaa-mm-dd, aaaa-mm-dd]`."""
+    dates = v.strip("[]").split(",") if v.startswith("[") else [v]
+    for date in dates:
+        utils.validate_iso_date(date.strip())
+    return v
+
+
+def validate_cnpj_do_vendedor(v: str) -> str:
+    digits = utils.only_digits(v)
+    if digits == patterns.CNPJ_COMPRADOR:
+        raise ValueError("CNPJ é o do comprador, use o do vendedor")
+    if len(digits) == 11:  # CPF of a pessoa física
+        return v
+    return utils.validate_cnpj(v)
+
+
+def validate_optional_chave(v: str | None) -> str | None:
+    return None if not v else utils.validate_chave_de_acesso(v)
+
+
+# checked on top of the field types, as soon as the streamed value is complete
+FIELD_VALIDATORS = {
+    "data": validate_data,
+    "cnpj_do_vendedor": validate_cnpj_do_vendedor,
+    "chave_de_acesso": validate_optional_chave,
+}
+
+
+def clean_field(name: str, value: Any) -> Any:
+    """
+    A blank nullable field is the model leaving it empty, as the prompt asks.
+    Dates still written dd/mm/aaaa, alone or in the list, are turned into ISO.
+    """
+    if name in NULLABLE_FIELDS and isinstance(value, str) and not value.strip():
+        return None
+    if name == "data" and isinstance(value, str):
+        return re.sub(patterns.DATE, lambda m: patterns.to_iso_date(m[1]), value)
+    return value
+
+
+@functools.lru_cache
+def get_type_adapter(annotation: Any) -> TypeAdapter:
+    return TypeAdapter(annotation)
+
+
+def validate_field(name: str, value: Any) -> str | None:
+    """Why a value of a NfeCampos field is invalid, None when it is valid."""
+    try:
+        get_type_adapter(NfeCampos.model_fields[name].annotation).validate_python(value)
+        if validator := FIELD_VALIDATORS.get(name):
+            validator(value)
+    except (TypeError, ValueError) as e:
+        return str(e)
+
+
+async def stream_fields(
+    schema: Type[OpenAISchema],
+    completion_kwargs: Dict[str, Any],
+) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """
+    Streams the `schema` function call and validates every field as soon as its
+    value is complete. Once more than MAX_INVALID_FIELDS are invalid the stream is
+    closed, cancelling the generation, and ValueError raised. Returns the valid
+    fields and the errors of the invalid or missing ones.
+    """
+    parser = ObjectStreamParser()
+    fields: Dict[str, Any] = {}
+    errors: Dict[str, str] = {}
+    fragments = llm.stream_function_arguments(
+        TIMEOUT_SEC, max_retries=2, **completion_kwargs
+    )
+    async with contextlib.aclosing(fragments):
+        async for fragment in fragments:
+            for name, value in parser.feed(fragment):
+                if name not in schema.model_fields:
+                    continue
+                value = clean_field(name, value)
+                if error := validate_field(name, value):
+                    errors[name] = error
+                else:
+                    fields[name] = value
+            if len(errors) > MAX_INVALID_FIELDS:
+                raise ValueError(f"Cancelled, too many invalid fields: {errors}")
+
+    for name, field in schema.model_fields.items():
+        if name not in fields and name not in errors and field.is_required():
+            errors[name] = "Campo ausente"
+    return fields, errors
+
+
+async def repair_fields(
+    errors: Dict[str, str],
+    user_prompt: str,
+    model: str,
+    temperature: float = 0.1,
+) -> Dict[str, Any]:
+    """
+    Asks again for the invalid fields only, telling the model what was wrong.
+    Nullable fields still invalid are left empty, ValueError for the others.
+    """
+    fields = tuple(name for name in NfeCampos.model_fields if name in errors)
+    schema = make_partial_schema(fields)
+    kwargs = make_completion_kwargs(schema, user_prompt, model, temperature)
+    feedback = "\n".join(f"{name}: {error}" for name, error in errors.items())
+    kwargs["messages"].append(
+        {
+            "role": "user",
+            "content": f"Os campos a seguir vieram inválidos, corrija-os:\n{feedback}",
+        }
+    )
     completion = await llm.completion_with_backoff(
-        async_timeout=TIMEOUT_SEC,
+        async_timeout=TIMEOUT_SEC, max_retries=2, **kwargs
+    )
+    repaired = {
+        name: clean_field(name, value)
+        for name, value in schema.from_response(completion).model_dump().items()
+    }
+    for name, value in repaired.items():
+        if error := validate_field(name, value):
+            if name not in NULLABLE_FIELDS:
+                raise ValueError(f"Repair of {name} still invalid: {error}")
+            repaired[name] = None
+    return repaired
+
+
+async def extract_fields(
+    schema: Type[OpenAISchema],
+    user_prompt: str,
+    model: str,
+    temperature: float = 0.1,
+) -> Dict[str, Any]:
+    """Streamed extraction of `schema`, then a repair request for what was invalid."""
+    kwargs = make_completion_kwargs(schema, user_prompt, model, temperature)
+    fields, errors = await stream_fields(schema, kwargs)
+    if errors:
+        log.warning(f"Repairing {len(errors)} invalid fields: {errors}")
+        fields.update(await repair_fields(errors, user_prompt, model, temperature))
+    return schema.model_validate(fields).model_dump()
+
+
+def prepare_document(document: str, input_filepath: str) -> Tuple[str, Dict[str, Any]]:
+    """The document to send and the fields already extracted locally."""
+    if input_filepath.lower().endswith(".xml"):
+        return prepare_xml_document(document)
+    return document, patterns.pre_extract(document)
+
+
+def make_completion_kwargs(
+    schema: Type[OpenAISchema],
+    user_prompt: str,
+    model: str,
+    temperature: float = 0.1,
+) -> Dict[str, Any]:
+    """Body of the chat completion forcing the `schema` function call."""
+    return dict(
         model=model,
-        functions=[NfeCampos.openai_schema],
+        functions=[schema.openai_schema],
         temperature=temperature,
-        function_call={"name": NfeCampos.openai_schema["name"]},
-        max_retries=2,
+        function_call={"name": schema.openai_schema["name"]},
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_prompt},
         ],
     )
+
+
+async def process_nfe_document(
+    document: str,
+    input_filepath: str,
+    temperature: float = 0.1,
+    known_fields: Dict[str, Any] | None = None,
+    prompt_tokens: int | None = None,
+    split_long: bool = True,
+    **kwargs,
+) -> None | NfeCampos:
+    """
+    Process an NFE document by calling the OpenAI API with a specified timeout and retries.
+    Fields in `known_fields` were extracted locally, the API is only asked for the rest.
+    `prompt_tokens` saves encoding the prompt again when the caller counted it.
+    Long documents go through `process_long_nfe_document` unless `split_long` is off.
+    Returns NfeCampos model or None if failed after retries.
+    """
+    known_fields = {**(known_fields or {}), "input_filepath": input_filepath}
+    schema = get_schema(known_fields)
+    if schema is None:
+        log.info(f"All fields of {input_filepath} extracted locally.")
+        return NfeCampos(**known_fields)
+
+    user_prompt = make_user_prompt(document, input_filepath)
+
+    if prompt_tokens is None:
+        prompt_tokens = count_prompt_overhead(schema) + count_tokens(
+            user_prompt, llm.DEFAULT_MODEL
+        )
+    if split_long and is_long_document(document, prompt_tokens):
+        return await process_long_nfe_document(
+            document, input_filepath, temperature, known_fields
+        )
+
+    # cheapest model first, escalating to the next one when validation fails
+    models = llm.route(round(prompt_tokens * llm.TOKENS_BETA))
+
+    if cached := lookup_extraction(document, schema, models):
+        log.info(f"Cache hit for {input_filepath}, skipping API call.")
+        return NfeCampos(**{**cached, **known_fields})
+
+    for model in models:
+        log.info(f"Extracting {input_filepath} with {model=}.")
+        try:
+            extracted = await extract_fields(schema, user_prompt, model, temperature)
+            nfe = NfeCampos(**{**extracted, **known_fields})
+        except Exception as e:
+            log.error(f"Failed to extract {input_filepath} with {model=}: {e}")
+            continue
+        log.info(f"Extracted NFe: {nfe.num_nf} with {model=}.")
+        EXTRACTION_CACHE.set(extraction_cache_key(document, model, schema), extracted)
+        return nfe
+
+    log.error(f"Every model failed to extract {input_filepath}: {models}")
+
+
+def is_long_document(document: str, prompt_tokens: int) -> bool:
+    """Beyond the window of every model, or with several pages worth filtering."""
+    num_tokens = round(prompt_tokens * llm.TOKENS_BETA)
+    if not any(
+        spec.fits(num_tokens, COMPLETION_TOKENS) for spec in llm.MODEL_REGISTRY.values()
+    ):
+        return True
+    return prompt_tokens > LONG_DOCUMENT_TOKENS and PAGE_SEPARATOR in document
+
+
+def route_chunk(schema: Type[OpenAISchema], user_prompt: str) -> str:
+    """Cheapest model for one chunk, it always fits since chunks are cut to size."""
+    prompt_tokens = count_prompt_overhead(schema) + count_tokens(
+        user_prompt, llm.DEFAULT_MODEL
+    )
+    return llm.route(round(prompt_tokens * llm.TOKENS_BETA))[0]
+
+
+async def extract_chunk(
+    chunk: str,
+    input_filepath: str,
+    schema: Type[OpenAISchema],
+    temperature: float = 0.1,
+) -> Dict[str, Any]:
+    """Fields found in one chunk, empty when the call or its parsing fails."""
+    user_prompt = make_user_prompt(chunk, input_filepath)
+    model = route_chunk(schema, user_prompt)
+    cache_key = extraction_cache_key(chunk, model, schema)
+    if cached := EXTRACTION_CACHE.get(cache_key):
+        return cached
     try:
-        model = NfeCampos.from_response(completion)
+        completion = await llm.completion_with_backoff(
+            async_timeout=TIMEOUT_SEC,
+            max_retries=2,
+            **make_completion_kwargs(schema, user_prompt, model, temperature),
+        )
+        extracted = schema.from_response(completion).model_dump()
     except Exception as e:
-        # !FIXME: pydantic_core._pydantic_core.ValidationError
-        log.error(f"Failed to parse response from OpenAI API: {e}")
-        log.error(f"Response: {completion}")
-        return
+        log.error(f"Failed to extract a chunk of {input_filepath}: {e}")
+        return {}
+    EXTRACTION_CACHE.set(cache_key, extracted)
+    return extracted
+
+
+async def process_long_nfe_document(
+    document: str,
+    input_filepath: str,
+    temperature: float = 0.1,
+    known_fields: Dict[str, Any] | None = None,
+) -> None | NfeCampos:
+    """
+    Map-reduce over a document too long to send whole. Only the first page and the
+    pages mentioning totals, dates, CNPJ or chave are kept. When those still don't
+    fit one call they are cut into at most MAX_CHUNKS chunks, extracted concurrently
+    and merged field by field (see `chunking.MERGE_RULES`).
+    """
+    known_fields = {**(known_fields or {}), "input_filepath": input_filepath}
+    pages = chunking.split_pages(document)
+    relevant = chunking.filter_pages(pages)
+    chunks = chunking.make_chunks(relevant, CHUNK_TOKENS, llm.DEFAULT_MODEL)
     log.info(
-        f"Total tokens spent for NFe: {model.num_nf} was {completion['usage']['total_tokens']}"
+        f"Kept {len(relevant)} of {len(pages)} pages of {input_filepath}, "
+        f"in {len(chunks)} chunks."
+    )
+    if len(chunks) > MAX_CHUNKS:
+        log.warning(f"Only the first {MAX_CHUNKS} chunks of {input_filepath} are sent.")
+        chunks = chunks[:MAX_CHUNKS]
+    if len(chunks) == 1:
+        return await process_nfe_document(
+            chunks[0],
+            input_filepath,
+            temperature,
+            known_fields=known_fields,
+            split_long=False,
+        )
+
+    schema = make_chunk_schema(tuple(get_schema(known_fields).model_fields))
+    partials = await asyncio.gather(
+        *(extract_chunk(chunk, input_filepath, schema, temperature) for chunk in chunks)
     )
-    return model
+    merged = {
+        name: clean_field(name, value)
+        for name, value in chunking.merge_partials(partials).items()
+    }
+    errors = {
+        name: error
+        for name, value in merged.items()
+        if (error := validate_field(name, value))
+    }
+    if errors:
+        log.warning(f"Repairing {len(errors)} merged fields of {input_filepath}.")
+        # asked again with the first chunk an invalid value came from
+        chunk = next(
+            (
+                chunk
+                for chunk, partial in zip(chunks, partials)
+                if any(partial.get(name) not in (None, "") for name in errors)
+            ),
+            chunks[0],
+        )
+        user_prompt = make_user_prompt(chunk, input_filepath)
+        try:
+            merged.update(
+                await repair_fields(
+                    errors,
+                    user_prompt,
+                    route_chunk(schema, user_prompt),
+                    temperature,
+                )
+            )
+        except Exception as e:
+            log.error(f"Failed to repair the merged chunks of {input_filepath}: {e}")
+            return None
+    try:
+        return NfeCampos(**{**merged, **known_fields})
+    except ValidationError as e:
+        log.error(f"Merged chunks of {input_filepath} are invalid: {e}")
 
 
-@log.catch
-async def run():
-    start_of_process = pd.Timestamp.now()
-    filepaths_contents = utils.load_fresh_nfes(
-        NFES_INPUT, NFES_OUTPUT, keep_first_page_only=False
+async def extract_nfe_document(
+    document: str,
+    input_filepath: str,
+    known_fields: Dict[str, Any] | None = None,
+    prompt_tokens: int | None = None,
+) -> Tuple[str, None | NfeCampos, Dict[str, float]]:
+    """
+    Wraps `process_nfe_document` so each result carries its own filepath and timings,
+    regardless of the order in which results complete.
+    """
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        nfe = await process_nfe_document(
+            document,
+            input_filepath,
+            known_fields=known_fields,
+            prompt_tokens=prompt_tokens,
+        )
+    except Exception as e:
+        log.error(f"Failed to process {input_filepath}: {e}")
+        nfe = None
+    timings = {"started_at": started_at, "elapsed_sec": time.perf_counter() - start}
+    return input_filepath, nfe, timings
+
+
+PackItem = Tuple[str, str, Dict[str, Any]]  # document, input_filepath, known_fields
+
+
+def make_pack_prompt(items: List[PackItem]) -> str:
+    return "\n\n---\n\n".join(
+        make_user_prompt(document, input_filepath)
+        for document, input_filepath, _ in items
     )
 
-    if not filepaths_contents:
-        return
 
-    tasks = [
-        asyncio.create_task(process_nfe_document(content, filepath))
-        for filepath, content in filepaths_contents
+async def process_nfe_pack(
+    items: List[PackItem], temperature: float = 0.1
+) -> Dict[str, None | NfeCampos]:
+    """
+    Extracts several small documents with a single call, paying the schema and the
+    system prompt once. Cached documents are left out and the pack only asks for
+    the fields some document still misses. Results are matched back by
+    `input_filepath` and cached under the key `process_nfe_document` reads. A
+    pack the model answers invalidly is split in halves, documents it leaves out
+    or answers with invalid fields are extracted on their own.
+    """
+    results: Dict[str, None | NfeCampos] = {}
+    pending: Dict[str, Tuple[str, Dict[str, Any], Type[OpenAISchema]]] = {}
+    for document, input_filepath, known_fields in items:
+        known_fields = {**known_fields, "input_filepath": input_filepath}
+        schema = get_schema(known_fields)
+        if schema is None:
+            results[input_filepath] = NfeCampos(**known_fields)
+        elif cached := lookup_extraction(document, schema, llm.ROUTER_MODELS):
+            log.info(f"Cache hit for {input_filepath}, skipping API call.")
+            results[input_filepath] = NfeCampos(**{**cached, **known_fields})
+        else:
+            pending[input_filepath] = (document, known_fields, schema)
+
+    if len(pending) == 1:
+        input_filepath, (document, known_fields, _) = next(iter(pending.items()))
+        results[input_filepath] = await process_nfe_document(
+            document, input_filepath, temperature, known_fields=known_fields
+        )
+    if len(pending) <= 1:
+        return results
+
+    fields = tuple(
+        name
+        for name in NfeCampos.model_fields
+        if name == "input_filepath"
+        or any(name in schema.model_fields for _, _, schema in pending.values())
+    )
+    pack_schema = make_pack_schema(fields)
+    rest = [
+        (document, input_filepath, known_fields)
+        for input_filepath, (document, known_fields, _) in pending.items()
     ]
-    filepaths = [filepath for filepath, _ in filepaths_contents]
+    user_prompt = make_pack_prompt(rest)
+    prompt_tokens = count_prompt_overhead(pack_schema) + count_tokens(
+        user_prompt, llm.DEFAULT_MODEL
+    )
+    model = llm.route(
+        round(prompt_tokens * llm.TOKENS_BETA), COMPLETION_TOKENS * len(pending)
+    )[0]
+    log.info(f"Extracting a pack of {len(pending)} documents with {model=}.")
+    completion = await llm.completion_with_backoff(
+        async_timeout=TIMEOUT_SEC,
+        max_retries=2,
+        **make_completion_kwargs(pack_schema, user_prompt, model, temperature),
+    )
+    try:
+        notas = pack_schema.from_response(completion).notas
+    except Exception as e:
+        log.warning(f"Invalid answer for a pack of {len(pending)}, splitting it: {e}")
+        half = len(rest) // 2
+        return {
+            **results,
+            **await process_nfe_pack(rest[:half], temperature),
+            **await process_nfe_pack(rest[half:], temperature),
+        }
+    total_tokens = completion["usage"]["total_tokens"]
+    log.info(f"Total tokens spent for a pack of {len(pending)} was {total_tokens}")
+
+    for nota in notas:
+        if nota.input_filepath not in pending or nota.input_filepath in results:
+            continue
+        document, known_fields, schema = pending[nota.input_filepath]
+        extracted = {
+            name: clean_field(name, value)
+            for name, value in nota.model_dump().items()
+            if name in schema.model_fields
+        }
+        errors = {
+            name: error
+            for name, value in extracted.items()
+            if (error := validate_field(name, value))
+        }
+        if errors:
+            log.warning(
+                f"Invalid fields of {nota.input_filepath} in the pack: {errors}"
+            )
+            continue
+        results[nota.input_filepath] = NfeCampos(**{**extracted, **known_fields})
+        EXTRACTION_CACHE.set(extraction_cache_key(document, model, schema), extracted)
+
+    for input_filepath, (document, known_fields, _) in pending.items():
+        if input_filepath not in results:
+            log.warning(f"{input_filepath} not extracted by the pack, retrying alone.")
+            results[input_filepath] = await process_nfe_document(
+                document, input_filepath, temperature, known_fields=known_fields
+            )
+    return results
+
+
+async def extract_nfe_pack(
+    jobs: List[Tuple[str, str, Dict[str, Any], int]],
+) -> List[Tuple[str, None | NfeCampos, Dict[str, float]]]:
+    """`extract_nfe_document` for a pack of jobs, every result shares its timings."""
+    if len(jobs) == 1:
+        return [await extract_nfe_document(*jobs[0])]
+
+    started_at = time.time()
+    start = time.perf_counter()
+    items = [job[:3] for job in jobs]
+    try:
+        nfes = await process_nfe_pack(items)
+    except Exception as e:
+        log.error(f"Failed to process a pack of {len(jobs)}: {e}")
+        nfes = {}
+    timings = {"started_at": started_at, "elapsed_sec": time.perf_counter() - start}
+    return [(filepath, nfes.get(filepath), timings) for _, filepath, _, _ in jobs]
+
+
+async def pack_jobs(
+    jobs: AsyncIterable[Tuple[int, Tuple]],
+    max_tokens: int = PACK_MAX_TOKENS,
+    max_documents: int = PACK_MAX_DOCUMENTS,
+) -> AsyncIterator[Tuple[int, Tuple]]:
+    """
+    Groups the jobs of small documents, up to `max_tokens` of documents or
+    `max_documents` per pack, into jobs of `extract_nfe_pack`. Documents above
+    half the budget, or with nothing left to ask, go alone.
+    """
+    overhead = count_prompt_overhead(NfeCampos)
+    pack, pack_tokens = [], 0
+
+    def pack_job():
+        prompt_tokens = round((overhead + pack_tokens) * llm.TOKENS_BETA)
+        return prompt_tokens + COMPLETION_TOKENS * len(pack), (pack,)
 
-    for task, filepath in zip(asyncio.as_completed(tasks), filepaths):
-        nfe = await task
-        if not nfe:
-            log.info(f"Skipping file: {filepath} due to failed API call.")
+    async for cost, args in jobs:
+        document, input_filepath, known_fields, prompt_tokens = args
+        schema = get_schema({**known_fields, "input_filepath": input_filepath})
+        document_tokens = prompt_tokens - count_prompt_overhead(schema) if schema else 0
+        if schema is None or document_tokens > max_tokens // 2:
+            yield cost, ([args],)
             continue
-        filename = os.path.basename(filepath)
-        log.info(f"Processing file: {filename}")
-        # file_info = f"{filename=} {nfe.numero_da_nota=} {nfe.razao_social_vendedor=}"
+        if pack and (
+            pack_tokens + document_tokens > max_tokens or len(pack) >= max_documents
+        ):
+            yield pack_job()
+            pack, pack_tokens = [], 0
+        pack.append(args)
+        pack_tokens += document_tokens
+    if pack:
+        yield pack_job()
+
+
+async def make_jobs(
+    filepaths_contents: AsyncIterable[Tuple[str, str]],
+    batch_size: int = COUNT_BATCH_SIZE,
+) -> AsyncIterator[Tuple[int, Tuple]]:
+    """
+    Pre-extracts what it can locally and counts the prompts once, `batch_size`
+    documents per call off the event loop. The cost paces the scheduler, the
+    count is reused to choose the model.
+    """
+    batch: List[Tuple[str, str, Dict[str, Any], Type[OpenAISchema] | None]] = []
+
+    async def flush():
+        prompts = [
+            make_user_prompt(document, input_filepath)
+            for document, input_filepath, _, schema in batch
+            if schema is not None
+        ]
+        counts = iter(
+            await acount_tokens_batch(prompts, llm.DEFAULT_MODEL) if prompts else []
+        )
+        for document, input_filepath, known_fields, schema in batch:
+            prompt_tokens = 0
+            if schema is not None:
+                prompt_tokens = count_prompt_overhead(schema) + next(counts)
+            cost = round(prompt_tokens * llm.TOKENS_BETA) + COMPLETION_TOKENS
+            yield cost, (document, input_filepath, known_fields, prompt_tokens)
+
+    async for input_filepath, content in filepaths_contents:
+        document, known_fields = prepare_document(content, input_filepath)
+        schema = get_schema({**known_fields, "input_filepath": input_filepath})
+        batch.append((document, input_filepath, known_fields, schema))
+        if len(batch) >= batch_size:
+            async for job in flush():
+                yield job
+            batch = []
+    async for job in flush():
+        yield job
+
 
-        utils.dataclass_to_pandas(
-            [nfe], timestamp="data", filepath=NFES_OUTPUT, inserted_at=start_of_process
+@log.catch
+async def run():
+    start_of_process = pd.Timestamp.now()
+    llm.set_deadline(RUN_DEADLINE_SEC)
+    async with llm.pooled_session():
+        await process_fresh_nfes(start_of_process)
+
+    EXTRACTION_CACHE.evict()
+
+
+async def process_fresh_nfes(start_of_process: pd.Timestamp):
+    with NfeStore(NFES_STORE) as store, Manifest(MANIFEST_FILE) as index:
+        store.import_csv(NFES_OUTPUT)
+        if not index.count(PROCESSED):
+            index.import_index(LEGACY_INDEX)
+            index.seed(store.input_filepaths())
+
+        filepaths_contents = utils.stream_fresh_nfes(
+            NFES_INPUT, index, keep_first_page_only=False, queue_size=QUEUE_SIZE
         )
-        # log.info(f"Saving fields to csv of file: {file_info}")
+
+        scheduler = Scheduler(
+            max_workers=MAX_WORKERS,
+            requests_per_minute=REQUESTS_PER_MINUTE,
+            tokens_per_minute=TOKENS_PER_MINUTE,
+            headroom=RATE_LIMIT_HEADROOM,
+        )
+        # parsing overlaps the API calls, smallest documents of the queue go first
+        jobs = pack_jobs(make_jobs(filepaths_contents))
+        unflushed_filepaths = []
+
+        results = scheduler.map(extract_nfe_pack, jobs, queue_size=QUEUE_SIZE)
+        async for pack in results:
+            for filepath, nfe, timings in pack or []:
+                filename = os.path.basename(filepath)
+                if not nfe:
+                    log.info(f"Skipping file: {filename} due to failed API call.")
+                    index.mark_failed(filepath)
+                    continue
+                log.info(f"Processed file: {filename} in {timings['elapsed_sec']:.1f}s")
+                store.write(utils.model_to_row(nfe, start_of_process))
+                unflushed_filepaths.append(filepath)
+            # only mark files processed once their rows are committed to the store
+            if not store.buffered:
+                index.mark_processed_many(unflushed_filepaths)
+                unflushed_filepaths.clear()
+        store.flush()
+        index.mark_processed_many(unflushed_filepaths)
+        store.export_csv(NFES_OUTPUT)
 
 
 if __name__ == "__main__":
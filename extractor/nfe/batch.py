@@ -0,0 +1,309 @@
+"""Offline bulk extraction through the OpenAI Batch API
+
+Every pending document becomes one line of a JSONL batch file, with the same
+function call `process_nfe_document` makes. Results come back within the
+completion window at a fraction of the price and are ingested into the store.
+
+Usage: python extractor/nfe/batch.py [submit|collect|run]
+"""
+
+import abc
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List
+
+import pandas as pd
+from loguru import logger as log
+from openai.api_requestor import APIRequestor
+
+from extractor.config import ROOT_PATH, openai, settings
+import extractor.utils as utils
+from extractor.utils import llm
+from extractor.utils.cache import make_key
+from extractor.utils.manifest import Manifest
+from extractor.utils.store import NfeStore
+from extractor.utils.tokens import count_tokens
+from extractor import nfe
+from extractor.nfe import NfeCampos
+
+BATCH_DIR = utils.get_path(ROOT_PATH, settings["batch"]["dirpath"])
+BATCH_STATE = os.path.join(BATCH_DIR, "state.json")
+API_BASE = settings["batch"]["api_base"] or None  # empty: openai.api_base
+COMPLETION_WINDOW = settings["batch"]["completion_window"]
+POLL_INTERVAL_SEC = settings["batch"]["poll_interval_sec"]
+MAX_REQUESTS_PER_BATCH = settings["batch"]["max_requests_per_batch"]
+
+ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchBackend(abc.ABC):
+    """Where batch files are sent to, swap it to run against another provider."""
+
+    @abc.abstractmethod
+    def submit(self, filepath: str) -> str:
+        """Uploads the JSONL file and starts the batch, returns its id."""
+
+    @abc.abstractmethod
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        """The batch object, with at least `status` and `output_file_id`."""
+
+    @abc.abstractmethod
+    def results(self, batch: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """Output lines of a finished batch, `custom_id` and `response` each."""
+
+
+class OpenAIBatchBackend(BatchBackend):
+    """
+    The OpenAI Batch API. `api_base` points it to any compatible server, a local
+    stub included.
+    """
+
+    def __init__(self, api_base: str | None = None, completion_window: str = "24h"):
+        self.api_base = api_base
+        self.completion_window = completion_window
+        self.requestor = APIRequestor(api_base=api_base)
+
+    def submit(self, filepath: str) -> str:
+        with open(filepath, "rb") as file:
+            uploaded = openai.File.create(
+                file=file, purpose="batch", api_base=self.api_base
+            )
+        response, _, _ = self.requestor.request(
+            "post",
+            "/batches",
+            params={
+                "input_file_id": uploaded["id"],
+                "endpoint": ENDPOINT,
+                "completion_window": self.completion_window,
+            },
+        )
+        return response.data["id"]
+
+    def status(self, batch_id: str) -> Dict[str, Any]:
+        response, _, _ = self.requestor.request("get", f"/batches/{batch_id}")
+        return response.data
+
+    def results(self, batch: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        if not batch.get("output_file_id"):
+            return
+        content = openai.File.download(batch["output_file_id"], api_base=self.api_base)
+        for line in content.decode("utf-8").splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def load_state() -> Dict[str, Any]:
+    """Submitted batches and the requests still waiting for a result."""
+    if not os.path.exists(BATCH_STATE):
+        return {"batches": {}, "requests": {}}
+    with open(BATCH_STATE, encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_state(state: Dict[str, Any]):
+    tmp_filepath = f"{BATCH_STATE}.tmp"
+    with open(tmp_filepath, "w", encoding="utf-8") as file:
+        json.dump(state, file, ensure_ascii=False, indent=2)
+    os.replace(tmp_filepath, BATCH_STATE)
+
+
+def make_request(custom_id: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    return {"custom_id": custom_id, "method": "POST", "url": ENDPOINT, "body": body}
+
+
+def write_batch_file(filepath: str, requests: List[Dict[str, Any]]):
+    with open(filepath, "w", encoding="utf-8") as file:
+        for request in requests:
+            file.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+
+def submit(
+    backend: BatchBackend,
+    store: NfeStore,
+    index: Manifest,
+    start_of_process: pd.Timestamp,
+) -> int:
+    """
+    Writes a batch file per model for the fresh documents and submits them.
+    Documents fully extracted locally go straight to the store. Files are only
+    marked processed once their result is ingested, so a rerun before that
+    would submit them again: collect first. Long documents, which need chunked
+    extraction, and documents that fail to prepare are skipped and left to `run`.
+    """
+    state = load_state()
+    requests_by_model: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    local_filepaths = []
+
+    pending = {request["input_filepath"] for request in state["requests"].values()}
+    for input_filepath, content in utils.load_fresh_nfes(nfe.NFES_INPUT, index):
+        if input_filepath in pending:
+            continue
+        try:
+            document, known_fields = nfe.prepare_document(content, input_filepath)
+            known_fields = {**known_fields, "input_filepath": input_filepath}
+            schema = nfe.get_schema(known_fields)
+            if schema is None:
+                campos = NfeCampos(**known_fields)
+                store.write(utils.model_to_row(campos, start_of_process))
+                local_filepaths.append(input_filepath)
+                continue
+
+            user_prompt = nfe.make_user_prompt(document, input_filepath)
+            prompt_tokens = nfe.count_prompt_overhead(schema) + count_tokens(
+                user_prompt, llm.DEFAULT_MODEL
+            )
+            # chunked extraction needs several calls per document, leave it to `run`
+            if nfe.is_long_document(document, prompt_tokens):
+                log.warning(f"Skipping long document {input_filepath}, run `nfe`.")
+                continue
+            model = llm.route(round(prompt_tokens * llm.TOKENS_BETA))[0]
+            custom_id = make_key(input_filepath)
+            body = nfe.make_completion_kwargs(schema, user_prompt, model)
+        except Exception as e:
+            log.error(f"Failed to prepare {input_filepath} for a batch: {e}")
+            continue
+        requests_by_model[model].append(make_request(custom_id, body))
+        state["requests"][custom_id] = {
+            "input_filepath": input_filepath,
+            "known_fields": known_fields,
+            "cache_key": nfe.extraction_cache_key(document, model, schema),
+        }
+
+    store.flush()
+    index.mark_processed_many(local_filepaths)
+
+    os.makedirs(BATCH_DIR, exist_ok=True)
+    stamp = start_of_process.strftime("%Y%m%d%H%M%S")
+    submitted = 0
+    for model, requests in requests_by_model.items():
+        for start in range(0, len(requests), MAX_REQUESTS_PER_BATCH):
+            chunk = requests[start : start + MAX_REQUESTS_PER_BATCH]
+            filepath = os.path.join(BATCH_DIR, f"{stamp}-{model}-{start}.jsonl")
+            write_batch_file(filepath, chunk)
+            batch_id = backend.submit(filepath)
+            state["batches"][batch_id] = {
+                "model": model,
+                "filepath": filepath,
+                "status": "submitted",
+            }
+            submitted += len(chunk)
+            log.info(f"Submitted batch {batch_id} of {len(chunk)} requests to {model}.")
+    save_state(state)
+    log.info(f"Extracted {len(local_filepaths)} documents locally.")
+    return submitted
+
+
+def ingest(
+    backend: BatchBackend,
+    batch: Dict[str, Any],
+    state: Dict[str, Any],
+    store: NfeStore,
+    index: Manifest,
+    start_of_process: pd.Timestamp,
+) -> int:
+    """
+    Validates the results of a finished batch like the interactive path does and
+    writes them to the store. Answers with invalid fields are not ingested, their
+    files are left to `run`, which repairs them.
+    """
+    filepaths = []
+    for result in backend.results(batch):
+        request = state["requests"].pop(result["custom_id"], None)
+        if request is None:
+            continue
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            log.error(f"Batch request for {request['input_filepath']} failed: {result}")
+            continue
+
+        known_fields = request["known_fields"]
+        schema = nfe.get_schema(known_fields)
+        try:
+            answer = schema.from_response(response["body"]).model_dump()
+            extracted = {
+                name: nfe.clean_field(name, value) for name, value in answer.items()
+            }
+            campos = NfeCampos(**{**extracted, **known_fields})
+        except Exception as e:
+            log.error(f"Failed to parse batch response: {e}")
+            log.error(f"Response: {response['body']}")
+            continue
+        errors = {
+            name: error
+            for name, value in extracted.items()
+            if (error := nfe.validate_field(name, value))
+        }
+        if errors:
+            log.warning(
+                f"Invalid fields of {request['input_filepath']}, left to `run`: "
+                f"{errors}"
+            )
+            continue
+        nfe.EXTRACTION_CACHE.set(request["cache_key"], extracted)
+        store.write(utils.model_to_row(campos, start_of_process))
+        filepaths.append(request["input_filepath"])
+
+    store.flush()
+    index.mark_processed_many(filepaths)
+    return len(filepaths)
+
+
+def collect(
+    backend: BatchBackend,
+    store: NfeStore,
+    index: Manifest,
+    start_of_process: pd.Timestamp,
+    wait: bool = True,
+) -> int:
+    """
+    Polls the submitted batches and ingests each one as it finishes. Requests a
+    batch did not answer are dropped from the state, the next run picks their
+    files up again since they were never marked processed.
+    """
+    state = load_state()
+    pending = {
+        batch_id
+        for batch_id, batch in state["batches"].items()
+        if batch["status"] not in TERMINAL_STATUSES
+    }
+    ingested = 0
+    while pending:
+        for batch_id in sorted(pending):
+            batch = backend.status(batch_id)
+            if batch["status"] not in TERMINAL_STATUSES:
+                continue
+            count = ingest(backend, batch, state, store, index, start_of_process)
+            ingested += count
+            log.info(f"Batch {batch_id} {batch['status']}, ingested {count} rows.")
+            state["batches"][batch_id]["status"] = batch["status"]
+            pending.discard(batch_id)
+            save_state(state)
+        if not pending or not wait:
+            break
+        log.info(f"Waiting on {len(pending)} batches.")
+        time.sleep(POLL_INTERVAL_SEC)
+
+    if not pending:
+        state["requests"].clear()
+        save_state(state)
+    return ingested
+
+
+def main(command: str = "run", backend: BatchBackend | None = None):
+    backend = backend or OpenAIBatchBackend(API_BASE, COMPLETION_WINDOW)
+    # one inserted_at per run, the Airtable export only takes the latest one
+    start_of_process = pd.Timestamp.now()
+    with NfeStore(nfe.NFES_STORE) as store, Manifest(nfe.MANIFEST_FILE) as index:
+        if command in ("submit", "run"):
+            submit(backend, store, index, start_of_process)
+        if command in ("collect", "run"):
+            collect(backend, store, index, start_of_process, wait=command == "run")
+        store.export_csv(nfe.NFES_OUTPUT)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else "run")
@@ -0,0 +1,108 @@
+"""Map-reduce helpers for documents too long to send whole: pages, chunks and merging"""
+
+import re
+from collections import Counter
+from typing import Any, Callable, Dict, List
+
+from extractor.loader import PAGE_SEPARATOR
+from extractor.nfe import patterns
+from extractor.utils.tokens import get_encoding
+
+# Pages mentioning any of these carry the fields we extract, the rest is usually
+# terms and conditions, item listings or blank pages
+RELEVANT = re.compile(
+    r"TOTAL|VENCIMENTO|PARCELA|DUPLICATA|CHAVE\s+DE\s+ACESSO|CNPJ|EMISS[ÃA]O",
+    re.IGNORECASE,
+)
+DATES = re.compile(r"\d{4}-\d{2}-\d{2}")
+
+
+def split_pages(document: str) -> List[str]:
+    return [page for page in document.split(PAGE_SEPARATOR) if page.strip()]
+
+
+def is_relevant(page: str) -> bool:
+    return bool(
+        RELEVANT.search(page)
+        or patterns.CHAVE.search(page)
+        or patterns.CNPJ.search(page)
+    )
+
+
+def filter_pages(pages: List[str]) -> List[str]:
+    """The first page, which names the emitente and the items, and the relevant ones."""
+    return pages[:1] + [page for page in pages[1:] if is_relevant(page)]
+
+
+def split_tokens(text: str, max_tokens: int, model: str) -> List[str]:
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        encoding.decode(tokens[start : start + max_tokens])
+        for start in range(0, len(tokens), max_tokens)
+    ]
+
+
+def make_chunks(pages: List[str], max_tokens: int, model: str) -> List[str]:
+    """
+    Packs consecutive pages into chunks of up to `max_tokens`, pages larger than
+    that are cut by tokens.
+    """
+    encoding = get_encoding(model)
+    chunks: List[str] = []
+    chunk: List[str] = []
+    chunk_tokens = 0
+    for page in pages:
+        page_tokens = len(encoding.encode(page, disallowed_special=()))
+        if chunk and chunk_tokens + page_tokens > max_tokens:
+            chunks.append(PAGE_SEPARATOR.join(chunk))
+            chunk, chunk_tokens = [], 0
+        if page_tokens > max_tokens:
+            chunks.extend(split_tokens(page, max_tokens, model))
+            continue
+        chunk.append(page)
+        chunk_tokens += page_tokens
+    if chunk:
+        chunks.append(PAGE_SEPARATOR.join(chunk))
+    return chunks
+
+
+def most_common(values: List[Any]) -> Any:
+    """Most frequent value, the earliest chunk wins ties."""
+    return Counter(values).most_common(1)[0][0]
+
+
+def most_dates(values: List[str]) -> str:
+    """The due dates usually sit in a single chunk, the others see the emission."""
+    return max(
+        values, key=lambda value: (len(DATES.findall(value)), values.count(value))
+    )
+
+
+def join_unique(values: List[str]) -> str:
+    return ", ".join(dict.fromkeys(value.strip() for value in values))
+
+
+# field -> how the non empty values of the chunks are reconciled
+MERGE_RULES: Dict[str, Callable[[List[Any]], Any]] = {
+    "data": most_dates,
+    "categoria": join_unique,
+    # partial chunks see subtotals and single installments, never more than the total
+    "valor": max,
+    "numero_de_parcelas": max,
+}
+
+
+def merge_partials(partials: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Reconciles the fields extracted from each chunk, in document order."""
+    fields = {name for partial in partials for name in partial}
+    merged: Dict[str, Any] = {}
+    for name in fields:
+        values = [
+            partial[name] for partial in partials if partial.get(name) not in (None, "")
+        ]
+        if values:
+            merged[name] = MERGE_RULES.get(name, most_common)(values)
+        else:
+            merged[name] = None
+    return merged
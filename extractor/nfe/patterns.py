@@ -0,0 +1,96 @@
+"""Deterministic pre-extraction of the regular NfeCampos fields with compiled patterns"""
+
+import re
+from typing import Any, Dict, List
+
+import extractor.utils as utils
+
+# CNPJ of the buyer, never the one we want (see NfeCampos.cnpj_do_vendedor)
+CNPJ_COMPRADOR = "55295125000188"
+
+CHAVE = re.compile(r"(?<![\d])(\d{4}(?:[ .]?\d{4}){10})(?![\d])")
+CNPJ = re.compile(r"(?<![\d])(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})(?![\d])")
+DATE = r"(\d{2}/\d{2}/\d{4})"
+MONEY = r"R?\$?\s*(\d{1,3}(?:\.\d{3})*,\d{2})(?![\d])"
+LABEL_GAP = r"[\s:]*"
+
+DATA_VENCIMENTO = re.compile(r"VENCIMENTO" + LABEL_GAP + DATE, re.IGNORECASE)
+DATA_EMISSAO = re.compile(
+    r"DATA\s+(?:DE\s+|DA\s+)?EMISS[ÃA]O" + LABEL_GAP + DATE, re.IGNORECASE
+)
+MENCIONA_VENCIMENTO = re.compile(r"VENCIMENTO|DUPLICATA|PARCELA", re.IGNORECASE)
+VALOR_TOTAL = re.compile(
+    r"VALOR\s+(?:TOTAL\s+DA\s+NOTA|L[ÍI]QUIDO(?:\s+DA\s+NOTA)?)" + LABEL_GAP + MONEY,
+    re.IGNORECASE,
+)
+
+
+def to_iso_date(date: str) -> str:
+    day, month, year = date.split("/")
+    return f"{year}-{month}-{day}"
+
+
+def to_float(money: str) -> float:
+    return float(money.replace(".", "").replace(",", "."))
+
+
+def is_valid(validator, v) -> bool:
+    try:
+        validator(v)
+    except ValueError:
+        return False
+    return True
+
+
+def find_chaves(document: str) -> List[str]:
+    chaves = [utils.only_digits(match) for match in CHAVE.findall(document)]
+    return list(
+        dict.fromkeys(
+            chave for chave in chaves if is_valid(utils.validate_chave_de_acesso, chave)
+        )
+    )
+
+
+def find_cnpjs(document: str) -> List[str]:
+    cnpjs = [
+        cnpj
+        for cnpj in CNPJ.findall(document)
+        if utils.only_digits(cnpj) != CNPJ_COMPRADOR
+        and is_valid(utils.validate_cnpj, cnpj)
+    ]
+    return list(dict.fromkeys(cnpjs))
+
+
+def pre_extract(document: str) -> Dict[str, Any]:
+    """
+    Fills only the fields found unambiguously and validated, the model is asked
+    for everything else. A valid chave de acesso also carries the CNPJ of the
+    emitente and the number of the nota.
+    """
+    fields: Dict[str, Any] = {}
+
+    chaves = find_chaves(document)
+    if len(chaves) == 1:
+        chave = chaves[0]
+        fields["chave_de_acesso"] = chave
+        fields["num_nf"] = int(chave[25:34])
+        cnpj = chave[6:20]
+        if cnpj != CNPJ_COMPRADOR and is_valid(utils.validate_cnpj, cnpj):
+            fields["cnpj_do_vendedor"] = utils.format_cnpj(cnpj)
+
+    cnpjs = find_cnpjs(document)
+    if "cnpj_do_vendedor" not in fields and len(cnpjs) == 1:
+        fields["cnpj_do_vendedor"] = cnpjs[0]
+
+    valores = {to_float(valor) for valor in VALOR_TOTAL.findall(document)}
+    if len(valores) == 1:
+        fields["valor"] = valores.pop()
+
+    vencimentos = list(dict.fromkeys(DATA_VENCIMENTO.findall(document)))
+    emissoes = set(DATA_EMISSAO.findall(document))
+    if len(vencimentos) == 1:
+        fields["data"] = to_iso_date(vencimentos[0])
+    elif len(emissoes) == 1 and not MENCIONA_VENCIMENTO.search(document):
+        fields["data"] = to_iso_date(emissoes.pop())
+
+    return fields
@@ -0,0 +1,134 @@
+"""Native NF-e / NFS-e XML extraction, maps tagged fields straight into NfeCampos"""
+
+import io
+import xml.etree.ElementTree as ET
+from typing import Any, Dict, List, NamedTuple
+
+import extractor.utils as utils
+
+# path suffix (local names) -> raw key, first occurrence wins unless repeated below
+NFE_PATHS = {
+    # NF-e, modelo 55/65
+    ("infProt", "chNFe"): "chave",
+    ("ide", "nNF"): "numero",
+    ("ide", "dhEmi"): "emissao",
+    ("ide", "dEmi"): "emissao",
+    ("emit", "CNPJ"): "cnpj",
+    ("emit", "CPF"): "cnpj",
+    ("emit", "xNome"): "fornecedor",
+    ("ICMSTot", "vNF"): "valor",
+    ("dup", "dVenc"): "vencimentos",
+    ("detPag", "tPag"): "pagamentos",
+    ("pag", "tPag"): "pagamentos",
+    ("prod", "xProd"): "itens",
+    # NFS-e, ABRASF and derivatives (GINFES, WebISS, ...)
+    ("InfNfse", "Numero"): "numero",
+    ("InfNfse", "DataEmissao"): "emissao",
+    ("Valores", "ValorLiquidoNfse"): "valor_liquido",
+    ("Valores", "ValorServicos"): "valor",
+    ("PrestadorServico", "RazaoSocial"): "fornecedor",
+    ("Prestador", "RazaoSocial"): "fornecedor",
+    ("Servico", "Discriminacao"): "itens",
+}
+REPEATED = {"vencimentos", "pagamentos", "itens"}
+
+# Prestador CNPJ sits at different depths depending on the layout version
+PRESTADOR_TAGS = {"PrestadorServico", "Prestador"}
+CNPJ_TAGS = {"Cnpj", "Cpf"}
+
+# tPag codes of the NF-e layout
+FORMAS_DE_PAGAMENTO = {
+    "01": "DINHEIRO",
+    "02": "CHEQUE",
+    "03": "CARTÃO DE CRÉDITO",
+    "04": "CARTÃO DE DÉBITO",
+    "05": "CRÉDITO LOJA",
+    "10": "VALE ALIMENTAÇÃO",
+    "11": "VALE REFEIÇÃO",
+    "12": "VALE PRESENTE",
+    "13": "VALE COMBUSTÍVEL",
+    "15": "BOLETO",
+    "16": "DEPÓSITO BANCÁRIO",
+    "17": "PIX",
+    "18": "TRANSFERÊNCIA",
+    "19": "PROGRAMA DE FIDELIDADE",
+    "90": "SEM PAGAMENTO",
+    "99": "OUTROS",
+}
+
+
+class XmlExtraction(NamedTuple):
+    fields: Dict[str, Any]
+    descriptions: List[str]
+
+
+def local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def iter_raw_values(document: str):
+    """Streams (key, text) pairs with iterparse, clearing elements once read."""
+    stack: List[str] = []
+    source = io.BytesIO(document.encode("utf-8"))
+    for event, element in ET.iterparse(source, events=("start", "end")):
+        name = local_name(element.tag)
+        if event == "start":
+            stack.append(name)
+            if name == "infNFe" and element.get("Id", "").startswith("NFe"):
+                yield "chave", element.get("Id")[3:]
+            continue
+
+        stack.pop()
+        text = (element.text or "").strip()
+        if text:
+            parent = stack[-1] if stack else ""
+            if (parent, name) in NFE_PATHS:
+                yield NFE_PATHS[(parent, name)], text
+            elif name in CNPJ_TAGS and PRESTADOR_TAGS.intersection(stack):
+                yield "cnpj", text
+        element.clear()
+
+
+def parse_xml(document: str) -> XmlExtraction:
+    """
+    Extracts the NfeCampos fields present in an NF-e or NFS-e XML. Fields missing
+    from the XML are left out, `categoria` never is in it, the item descriptions
+    are returned so that only they need to be sent to the model.
+    """
+    raw: Dict[str, Any] = {key: [] for key in REPEATED}
+    for key, text in iter_raw_values(document):
+        if key in REPEATED:
+            raw[key].append(text)
+        else:
+            raw.setdefault(key, text)
+
+    fields: Dict[str, Any] = {}
+    if raw.get("numero", "").isdigit():
+        fields["num_nf"] = int(raw["numero"])
+    try:
+        fields["valor"] = float(raw.get("valor_liquido", raw.get("valor")))
+    except (TypeError, ValueError):
+        pass
+    if "fornecedor" in raw:
+        fields["fornecedor"] = raw["fornecedor"]
+    if "cnpj" in raw:
+        fields["cnpj_do_vendedor"] = utils.format_cnpj(raw["cnpj"])
+    if "chave" in raw:
+        fields["chave_de_acesso"] = raw["chave"]
+
+    # data de pagamento: the due dates, otherwise the emission date
+    dates = [date[:10] for date in raw["vencimentos"]]
+    if len(dates) > 1:
+        fields["data"] = f"[{', '.join(dates)}]"
+    elif dates:
+        fields["data"] = dates[0]
+    elif "emissao" in raw:
+        fields["data"] = raw["emissao"][:10]
+    if raw["vencimentos"]:
+        fields["numero_de_parcelas"] = len(raw["vencimentos"])
+
+    formas = [FORMAS_DE_PAGAMENTO.get(code, code) for code in raw["pagamentos"]]
+    if formas:
+        fields["forma"] = ", ".join(dict.fromkeys(formas))
+
+    return XmlExtraction(fields, raw["itens"])
@@ -1,17 +1,16 @@
 import os
+import datetime
 import hashlib
-from instructor import OpenAISchema
 import pandas as pd
 from pydantic import BaseModel
-from typing import List, Callable, Iterator, Any, Tuple, Union
+from typing import List, AsyncIterator, Callable, Dict, Iterator, Any, Tuple, Union
 import csv
 from loguru import logger as log
-from typing import Type
+from typing import TYPE_CHECKING, Type
 
-from extractor import PATH_NFE
 
-
-DOWNLOAD_URLS = PATH_NFE / "output" / "download_urls.csv"
+if TYPE_CHECKING:
+    from extractor.utils.manifest import Manifest
 
 
 def open_xml_as_txt(file_path: str) -> str:
@@ -28,49 +27,11 @@ def get_files(root_path: str, list_paths: None | List[str] = None) -> List[str]:
     return [os.path.join(target_path, file) for file in os.listdir(target_path)]
 
 
-def dataclass_to_pandas(
-    models: List[OpenAISchema], timestamp: str, filepath: str, inserted_at: pd.Timestamp
-) -> pd.DataFrame:
-    # Convert your dataclass models to a DataFrame
-    incoming_df = pd.DataFrame([model.dict(by_alias=True) for model in models])
-
-    # Drop columns where all elements are NA
-    incoming_df = incoming_df.dropna(axis=1, how="all")
-
-    # create a column that is the current timestamp
-    incoming_df["inserted_at"] = inserted_at
-
-    # add the "download_url" from
-    download_urls = pd.read_csv(DOWNLOAD_URLS)
-    # keys: filename, download_url
-    # now use the filename to match with the "input_filepath" in the incomding_df so we can add the download_url to the dataframe
-    incoming_df["input_filename"] = incoming_df["input_filepath"].apply(
-        lambda x: x.split("/")[-1] if isinstance(x, str) else None
-    )
-    # Merge the incoming_df with download_urls on the 'input_filename' and 'filename' columns
-    incoming_df = incoming_df.merge(
-        download_urls, left_on="input_filename", right_on="filename", how="left"
-    )
-
-    # After merging, 'download_url' from download_urls will be in incoming_df
-    # You can drop the extra 'filename' column from the merge if not needed
-    incoming_df.drop("filename", axis=1, inplace=True)
-    incoming_df.drop("input_filename", axis=1, inplace=True)
-
-    if os.path.exists(filepath):
-        df = pd.read_csv(filepath)
-        # Also clean the existing dataframe
-        df = df.dropna(axis=1, how="all")
-        combined_df = pd.concat([df, incoming_df], ignore_index=True)
-    else:
-        combined_df = incoming_df
-
-    # Sort by the given timestamp column
-    combined_df = combined_df.sort_values(by=timestamp, ascending=False)
-    # Save the combined DataFrame to a CSV file
-    combined_df.to_csv(filepath, index=False)
-
-    return combined_df
+def model_to_row(model: BaseModel, inserted_at: pd.Timestamp) -> Dict[str, Any]:
+    """Download links are only generated at the Airtable export, they expire."""
+    row = model.dict(by_alias=True)
+    row["inserted_at"] = inserted_at
+    return row
 
 
 def iterate_over_files(
@@ -137,24 +98,21 @@ def log_filepaths(filepaths_contents: List[Tuple[str, str]]):
 
 
 def load_fresh_nfes(
-    input_filesdir: str, output_file: str, keep_first_page_only: bool = False
+    input_filesdir: str, index: "Manifest", keep_first_page_only: bool = False
 ) -> List[Tuple[str, str]]:
+    """Only files that are new or changed since they were processed get parsed."""
     from extractor import loader
 
-    output_filepaths = []
-    if os.path.exists(output_file):
-        with open(output_file, "r") as f:
-            csv_reader = csv.DictReader(f)
-            for row in csv_reader:
-                output_filepaths.append(row.get("input_filepath"))
-
     input_files = loader.get_files(input_filesdir)
-    documents = loader.run(input_files, keep_first_page_only)
+    fresh_files = [file for file in input_files if not index.is_processed(file)]
+    log.info(f"Skipping {len(input_files) - len(fresh_files)} processed files.")
+    if not fresh_files:
+        return []
+
+    documents = loader.run(fresh_files, keep_first_page_only)
 
     filepaths_contents = [
-        (document.metadata["source"], document.page_content)
-        for document in documents
-        if document.metadata["source"] not in output_filepaths
+        (document.source, document.page_content) for document in documents
     ]
 
     log_filepaths(filepaths_contents)
@@ -162,6 +120,23 @@ def load_fresh_nfes(
     return filepaths_contents
 
 
+async def stream_fresh_nfes(
+    input_filesdir: str,
+    index: "Manifest",
+    keep_first_page_only: bool = False,
+    queue_size: int = 32,
+) -> AsyncIterator[Tuple[str, str]]:
+    """Streaming `load_fresh_nfes`, yields (filepath, content) as files are parsed."""
+    from extractor import loader
+
+    input_files = loader.get_files(input_filesdir)
+    fresh_files = [file for file in input_files if not index.is_processed(file)]
+    log.info(f"Processing {len(fresh_files)} new files.")
+
+    async for document in loader.stream(fresh_files, keep_first_page_only, queue_size):
+        yield document.source, document.page_content
+
+
 def get_string_from_basemodel(model: Type[BaseModel]) -> str:
     aliases = [
         field_info.alias
@@ -189,3 +164,70 @@ def validate_time(v):
     if v[2] != ":":
         raise ValueError("Horário deve estar no formato hh:mm:ss")
     return v
+
+
+def validate_iso_date(v):
+    if not v:
+        raise ValueError("Data não pode ser vazia")
+    if len(v) != 10:
+        raise ValueError("Data deve ter 10 caracteres")
+    if v[4] != "-" or v[7] != "-":
+        raise ValueError("Data deve estar no formato aaaa-mm-dd")
+    try:
+        datetime.date.fromisoformat(v)
+    except ValueError:
+        raise ValueError(f"Data inexistente: {v}") from None
+    return v
+
+
+def only_digits(v: str) -> str:
+    return "".join(char for char in v if char.isdigit())
+
+
+def format_cnpj(digits: str) -> str:
+    """XX.XXX.XXX/XXXX-XX for a CNPJ, XXX.XXX.XXX-XX for a CPF."""
+    if len(digits) == 14:
+        return f"{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:]}"
+    if len(digits) == 11:
+        return f"{digits[:3]}.{digits[3:6]}.{digits[6:9]}-{digits[9:]}"
+    return digits
+
+
+def cnpj_check_digits(digits: str) -> str:
+    """The two verification digits of the first 12 digits of a CNPJ."""
+    result = digits[:12]
+    weights = [6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2]
+    for start in (1, 0):
+        remainder = sum(int(d) * w for d, w in zip(result, weights[start:])) % 11
+        result += "0" if remainder < 2 else str(11 - remainder)
+    return result[12:]
+
+
+def chave_check_digit(digits: str) -> str:
+    """Modulo 11 verification digit of the first 43 digits of a chave de acesso."""
+    weights = [2, 3, 4, 5, 6, 7, 8, 9]
+    total = sum(int(d) * weights[i % 8] for i, d in enumerate(reversed(digits[:43])))
+    remainder = total % 11
+    return "0" if remainder < 2 else str(11 - remainder)
+
+
+def validate_cnpj(v):
+    if not v:
+        raise ValueError("CNPJ não pode ser vazio")
+    digits = only_digits(v)
+    if len(digits) != 14:
+        raise ValueError("CNPJ deve ter 14 dígitos")
+    if digits == digits[0] * 14 or cnpj_check_digits(digits) != digits[12:]:
+        raise ValueError("CNPJ com dígitos verificadores inválidos")
+    return v
+
+
+def validate_chave_de_acesso(v):
+    if not v:
+        raise ValueError("Chave de acesso não pode ser vazia")
+    digits = only_digits(v)
+    if len(digits) != 44:
+        raise ValueError("Chave de acesso deve ter 44 dígitos")
+    if chave_check_digit(digits) != digits[43]:
+        raise ValueError("Chave de acesso com dígito verificador inválido")
+    return v
@@ -0,0 +1,82 @@
+"""Content-addressed on-disk cache of LLM extractions"""
+
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from loguru import logger as log
+
+
+def make_key(*parts: str) -> str:
+    """Full sha256 over every part, length prefixed so boundaries can't collide."""
+    digest = hashlib.sha256()
+    for part in parts:
+        encoded = part.encode("utf-8")
+        digest.update(f"{len(encoded)}:".encode("utf-8"))
+        digest.update(encoded)
+    return digest.hexdigest()
+
+
+class ExtractionCache:
+    """
+    One JSON file per key under `dirpath/<key[:2]>/<key>.json`. Entries older than
+    `max_age_days` are dropped on read and on `evict`, which also removes the
+    least recently used entries until the cache fits in `max_size_mb`.
+    """
+
+    def __init__(self, dirpath: str, max_size_mb: float, max_age_days: float):
+        self.dirpath = dirpath
+        self.max_size_bytes = max_size_mb * 1024 * 1024
+        self.max_age_sec = max_age_days * 24 * 60 * 60
+        os.makedirs(dirpath, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.dirpath, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age_sec:
+                os.remove(path)
+                return None
+            with open(path, "r") as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        os.utime(path, (time.time(), os.path.getmtime(path)))  # atime marks usage
+        return value
+
+    def set(self, key: str, value: Dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(value, f, ensure_ascii=False, default=str)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for root, _, filenames in os.walk(self.dirpath):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.max_age_sec:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size_bytes:
+                break
+            os.remove(path)
+            total_size -= size
+            evicted += 1
+        if evicted:
+            log.info(f"Evicted {evicted} entries from the extraction cache.")
@@ -1,47 +1,351 @@
 import asyncio
-import tiktoken
+import contextlib
+import email.utils
+import json
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Deque, List
+
+import aiohttp
 from loguru import logger as log
 from tenacity import (
+    RetryCallState,
     retry,
     stop_after_attempt,
     wait_random_exponential,
-    retry_if_exception_type,
+    retry_if_exception,
 )  # for exponential backoff
 
-from extractor.config import openai
+from extractor.config import openai, settings
+from extractor.utils import scheduler
+from extractor.utils.tokens import count_tokens
+
+TIMEOUT_SEC = settings["llm"]["timeout_sec"]
+COMPLETION_TOKENS = settings["llm"]["completion_tokens"]
+ROUTER_MODELS = settings["llm"]["models"]
+ROUTER_SMALL_PROMPT_TOKENS = settings["llm"]["small_prompt_tokens"]
+MAX_ATTEMPTS = settings["llm"]["max_attempts"]
+BREAKER_FAILURES = settings["llm"]["breaker_failures"]
+BREAKER_COOLDOWN_SEC = settings["llm"]["breaker_cooldown_sec"]
+MAX_CONNECTIONS = settings["llm"]["max_connections"]
+KEEPALIVE_SEC = settings["llm"]["keepalive_sec"]
+LATENCY_BUDGET_SEC = settings["llm"]["latency_budget_sec"]
+LATENCY_WEIGHT = settings["llm"]["latency_weight_usd_per_sec"]
+
+# e.g. a local mock server, OPENAI_API_BASE in the environment works as well
+if settings["llm"]["api_base"]:
+    openai.api_base = settings["llm"]["api_base"]
+
+
+@dataclass
+class ModelSpec:
+    """
+    A model the router may pick. Prices are USD per 1k tokens. `max_prompt_tokens`
+    is the largest prompt we trust the model with, below its context window.
+    """
+
+    name: str
+    context_window: int
+    input_price: float
+    output_price: float
+    max_prompt_tokens: int | None = None
+    latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=200))
+
+    def observe(self, seconds: float):
+        self.latencies.append(seconds)
+
+    def latency(self, quantile: float) -> float:
+        """Observed latency quantile in seconds, 0 until a call was timed."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
 
-MODELS_LIMITS = {
-    # "gpt-3.5-turbo": 4000,
-    # "gpt-3.5-turbo-16k": 16000,
-    "gpt-4-turbo-preview": 128000,
-    # "gpt-4": 8192, -> overpriced
-    # "gpt-4-32k": 32000, -> overpriced
+    @property
+    def p50(self) -> float:
+        return self.latency(0.50)
+
+    @property
+    def p95(self) -> float:
+        return self.latency(0.95)
+
+    def cost(self, prompt_tokens: float, completion_tokens: float) -> float:
+        return (
+            prompt_tokens * self.input_price + completion_tokens * self.output_price
+        ) / 1000
+
+    def fits(self, prompt_tokens: float, completion_tokens: float) -> bool:
+        max_prompt_tokens = self.max_prompt_tokens or self.context_window
+        return (
+            prompt_tokens <= max_prompt_tokens
+            and prompt_tokens + completion_tokens <= self.context_window
+        )
+
+
+MODEL_REGISTRY = {
+    spec.name: spec
+    for spec in [
+        # cheap and fast, only trusted with short single page notas
+        ModelSpec(
+            "gpt-3.5-turbo-0125",
+            context_window=16385,
+            input_price=0.0005,
+            output_price=0.0015,
+            max_prompt_tokens=ROUTER_SMALL_PROMPT_TOKENS,
+        ),
+        ModelSpec(
+            "gpt-4-turbo-preview",
+            context_window=128000,
+            input_price=0.01,
+            output_price=0.03,
+        ),
+        # "gpt-4": 8192, -> overpriced
+        # "gpt-4-32k": 32000, -> overpriced
+    ]
+    if spec.name in ROUTER_MODELS
 }
 
+MODELS_LIMITS = {name: spec.context_window for name, spec in MODEL_REGISTRY.items()}
+
 
-def num_tokens_from_string(string: str, encoding_name: str, beta: float = 1.2) -> int:
-    encoding = tiktoken.encoding_for_model(encoding_name)
-    num_tokens = len(encoding.encode(string)) * beta
+DEFAULT_MODEL = next(reversed(MODELS_LIMITS))  # the most capable one
+TOKENS_BETA = 1.2  # safety margin over the tiktoken count
+
+
+def num_tokens_from_string(
+    string: str, encoding_name: str, beta: float = TOKENS_BETA
+) -> int:
+    num_tokens = count_tokens(string, encoding_name) * beta
     return round(num_tokens, 0)
 
 
-def chose_cheapest_model_given_limit(prompt: str, max_limit: int = 16001):
-    for model, limit in MODELS_LIMITS.items():
-        tokens = num_tokens_from_string(prompt, model)
-        if tokens <= limit and tokens <= max_limit:
-            log.info(f"Chose model {model=} with a prompt of {tokens=}.")
-            return model
-    log.error(f"Could not find a cheaper model that fit the token limits {tokens=}.")
+def route(
+    num_tokens: float,
+    completion_tokens: float = COMPLETION_TOKENS,
+    max_latency_sec: float | None = LATENCY_BUDGET_SEC,
+    latency_weight: float = LATENCY_WEIGHT,
+) -> List[str]:
+    """
+    Fallback chain of the models that can take a prompt of `num_tokens` (already
+    with the safety margin), by cost plus `latency_weight` USD per second of the
+    observed p95 latency. Models whose p95 exceeds `max_latency_sec` are left to
+    the end. Raises ValueError when no model fits.
+    """
+    candidates = [
+        spec
+        for spec in MODEL_REGISTRY.values()
+        if spec.fits(num_tokens, completion_tokens)
+    ]
+    if not candidates:
+        raise ValueError(f"No model fits a prompt of {num_tokens=}.")
+
+    def key(spec: ModelSpec):
+        too_slow = max_latency_sec is not None and spec.p95 > max_latency_sec
+        score = spec.cost(num_tokens, completion_tokens) + latency_weight * spec.p95
+        return too_slow, score
+
+    return [spec.name for spec in sorted(candidates, key=key)]
+
+
+def chose_cheapest_model_given_limit(
+    prompt: str = "", max_limit: int | None = None, num_tokens: float | None = None
+) -> str:
+    """
+    Pass the raw `num_tokens` when the prompt was already counted, otherwise the
+    prompt is encoded once. Raises ValueError when no model fits.
+    """
+    if num_tokens is not None:
+        tokens = round(num_tokens * TOKENS_BETA, 0)
+    else:
+        tokens = num_tokens_from_string(prompt, DEFAULT_MODEL)
+    if max_limit is not None and tokens > max_limit:
+        raise ValueError(f"Prompt of {tokens=} is above {max_limit=}.")
+    model = route(tokens)[0]
+    log.info(f"Chose model {model=} with a prompt of {tokens=}.")
+    return model
+
+
+@contextlib.asynccontextmanager
+async def pooled_session(
+    max_connections: int = MAX_CONNECTIONS, keepalive_sec: float = KEEPALIVE_SEC
+) -> AsyncIterator[aiohttp.ClientSession]:
+    """
+    One keep-alive connection pool for every OpenAI call made inside, instead of
+    the session per request `openai` opens otherwise. Tasks created inside inherit
+    it through the `openai.aiosession` context variable.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=max_connections, keepalive_timeout=keepalive_sec, ttl_dns_cache=300
+    )
+    async with aiohttp.ClientSession(connector=connector) as session:
+        token = openai.aiosession.set(session)
+        try:
+            yield session
+        finally:
+            openai.aiosession.reset(token)
+
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.RateLimitError,
+)
+
+
+TIMEOUT_ERRORS = (asyncio.TimeoutError, openai.error.Timeout)
+
+
+def is_retryable(e: BaseException) -> bool:
+    """
+    Timeouts, connection errors, 429s and 5xx are worth another attempt. Auth,
+    permission and invalid requests fail the same way every time, as does a 429
+    for an exhausted quota.
+    """
+    if isinstance(e, openai.error.RateLimitError):
+        return e.code != "insufficient_quota"
+    if isinstance(e, RETRYABLE_ERRORS):
+        return True
+    if isinstance(e, openai.error.APIError):
+        return (e.http_status or 500) >= 500
+    return False
+
+
+def get_retry_after(e: BaseException) -> float | None:
+    """Seconds asked for by the `retry-after-ms` / `Retry-After` headers, if any."""
+    headers = getattr(e, "headers", None) or {}
+    try:
+        if value := headers.get("retry-after-ms"):
+            return float(value) / 1000
+        if value := headers.get("retry-after"):
+            if value.replace(".", "", 1).isdigit():
+                return float(value)
+            retry_at = email.utils.parsedate_to_datetime(value).timestamp()
+            return max(0.0, retry_at - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class CircuitBreaker:
+    """
+    Shared by every concurrent call. A 429 with `Retry-After` pauses all of them
+    for that long, and `max_failures` retryable errors in a row open the circuit
+    for `cooldown_sec`, so the workers stop hammering an API that is down.
+    """
+
+    def __init__(self, max_failures: int, cooldown_sec: float):
+        self.max_failures = max_failures
+        self.cooldown_sec = cooldown_sec
+        self.failures = 0
+        self.open_until = 0.0
+
+    def trip(self, seconds: float):
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+
+    def record_failure(self, retry_after: float | None = None):
+        self.failures += 1
+        if retry_after is not None:
+            self.trip(retry_after)
+        if self.failures >= self.max_failures:
+            log.warning(
+                f"Circuit open for {self.cooldown_sec}s after {self.failures} errors."
+            )
+            self.trip(self.cooldown_sec)
+            self.failures = 0
+
+    def record_success(self):
+        self.failures = 0
+
+    async def wait(self):
+        """Until the circuit closes, or the run deadline if that comes first."""
+        while (remaining := self.open_until - time.monotonic()) > 0:
+            if (left := time_left()) is not None:
+                if left <= 0:
+                    return
+                remaining = min(remaining, left)
+            await asyncio.sleep(remaining)
+
+
+BREAKER = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN_SEC)
+_deadline: float | None = None
+
+
+def set_deadline(seconds: float | None):
+    """Overall budget of the run, no call nor retry starts past it."""
+    global _deadline
+    _deadline = None if seconds is None else time.monotonic() + seconds
+
+
+def time_left() -> float | None:
+    return None if _deadline is None else _deadline - time.monotonic()
+
+
+def wait_for_error(retry_state: RetryCallState) -> float:
+    """
+    Waits what the server asked for on a 429, short jittered backoff otherwise,
+    never past the run deadline.
+    """
+    e = retry_state.outcome.exception()
+    retry_after = get_retry_after(e)
+    if retry_after is not None:
+        wait = retry_after + random.uniform(0, 1)
+    elif isinstance(e, openai.error.RateLimitError):
+        wait = wait_random_exponential(multiplier=2, max=60)(retry_state)
+    else:
+        wait = wait_random_exponential(multiplier=0.5, max=10)(retry_state)
+    if (left := time_left()) is not None:
+        wait = max(0.0, min(wait, left))
+    return wait
+
+
+def stop_at_deadline(retry_state: RetryCallState) -> bool:
+    left = time_left()
+    return left is not None and left <= 0
+
+
+def log_retry(retry_state: RetryCallState):
+    e = retry_state.outcome.exception()
+    log.warning(
+        f"Retrying OpenAI call in {retry_state.next_action.sleep:.1f}s "
+        f"(attempt {retry_state.attempt_number}): {e!r}"
+    )
+
+
+def estimate_tokens(kwargs: dict) -> int:
+    """Tokens a chat completion with `kwargs` may spend, prompt and answer."""
+    prompt = json.dumps(kwargs.get("functions", []), ensure_ascii=False) + "".join(
+        message.get("content") or "" for message in kwargs.get("messages", [])
+    )
+    prompt_tokens = count_tokens(prompt, kwargs.get("model", DEFAULT_MODEL))
+    return round(prompt_tokens * TOKENS_BETA) + kwargs.get(
+        "max_tokens", COMPLETION_TOKENS
+    )
 
 
 @retry(
-    wait=wait_random_exponential(min=60, max=120),
-    stop=stop_after_attempt(20),
-    retry=retry_if_exception_type(Exception),
+    wait=wait_for_error,
+    stop=stop_after_attempt(MAX_ATTEMPTS) | stop_at_deadline,
+    retry=retry_if_exception(is_retryable),
+    before_sleep=log_retry,
+    reraise=True,
 )
 async def completion_with_backoff(async_timeout, **kwargs):
+    await BREAKER.wait()
+    await scheduler.acquire_call(lambda: estimate_tokens(kwargs))
+    if (left := time_left()) is not None:
+        if left <= 0:
+            raise TimeoutError("Run deadline exceeded before calling the OpenAI API.")
+        async_timeout = min(async_timeout, left)
+    # a stream is timed by its reader, this call only opens it
+    spec = None if kwargs.get("stream") else MODEL_REGISTRY.get(kwargs.get("model"))
+    start = time.perf_counter()
     try:
-        return await asyncio.wait_for(
+        completion = await asyncio.wait_for(
             openai.ChatCompletion.acreate(
                 **kwargs,
             ),
@@ -49,11 +353,55 @@ async def completion_with_backoff(async_timeout, **kwargs):
         )
     except Exception as e:
         log.error("Failed to get completion from OpenAI API.")
-        log.error(f"Exception: {e}")
+        log.error(f"Exception: {e!r}")
+        if is_retryable(e):
+            BREAKER.record_failure(get_retry_after(e))
+        # a timeout is a latency of at least that long, the slowest calls count most
+        if spec and isinstance(e, TIMEOUT_ERRORS):
+            spec.observe(time.perf_counter() - start)
         raise e
+    BREAKER.record_success()
+    if spec:
+        spec.observe(time.perf_counter() - start)
+    return completion
+
+
+async def stream_function_arguments(async_timeout, **kwargs) -> AsyncIterator[str]:
+    """
+    Fragments of the forced function call arguments as the model writes them.
+    Opening the stream is retried like any call, closing the generator early
+    drops the connection, which stops the generation. The latency observed for
+    the model is the whole stream, or up to a timeout.
+    """
+    spec = MODEL_REGISTRY.get(kwargs.get("model"))
+    start = time.perf_counter()
+    try:
+        chunks = await completion_with_backoff(async_timeout, stream=True, **kwargs)
+    except TIMEOUT_ERRORS:
+        if spec:
+            spec.observe(time.perf_counter() - start)
+        raise
+    try:
+        while True:
+            try:
+                chunk = await asyncio.wait_for(anext(chunks), timeout=async_timeout)
+            except StopAsyncIteration:
+                if spec:
+                    spec.observe(time.perf_counter() - start)
+                return
+            except TIMEOUT_ERRORS:
+                if spec:
+                    spec.observe(time.perf_counter() - start)
+                raise
+            delta = chunk["choices"][0].get("delta", {}) if chunk["choices"] else {}
+            if fragment := delta.get("function_call", {}).get("arguments"):
+                yield fragment
+    finally:
+        await chunks.aclose()
 
 
 if __name__ == "__main__":
     prompt = "Hello world, let's test tiktoken."
-    num_tokens_from_string(prompt, "gpt-3.5-turbo-16k")
+    num_tokens_from_string(prompt, DEFAULT_MODEL)
     chose_cheapest_model_given_limit(prompt, 16000)
+    print(route(16000))
@@ -0,0 +1,234 @@
+"""Persistent manifest of the input files, from their download to their extraction"""
+
+import hashlib
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+from loguru import logger as log
+
+DOWNLOADED = "downloaded"
+PROCESSED = "processed"
+FAILED = "failed"
+MAX_PARAMS = 500  # per IN (...) query, well under the SQLite limit
+
+
+class Link(NamedTuple):
+    dropbox_path: str | None
+    link: str | None
+    expires_at: float | None
+
+
+def sha256_of_file(filepath: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """
+    One row per input file, shared by the Dropbox sync, the loader and the
+    extraction: its Dropbox path and content hash, local path, temporary link
+    and extraction state. Every stage skips work with an indexed lookup.
+
+    Local files are keyed by path, mtime and size, so an unchanged file is
+    recognised without reading it. Only when those differ the content is hashed,
+    which still catches renamed or re-downloaded copies of a processed file.
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._conn = sqlite3.connect(filepath)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "local_path TEXT UNIQUE, mtime REAL, size INTEGER, sha256 TEXT, "
+            "dropbox_path TEXT, dropbox_hash TEXT, "
+            "link TEXT, link_expires_at REAL, "
+            "state TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS files_dropbox_hash ON files (dropbox_hash)"
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    # Dropbox sync
+
+    def is_downloaded(self, dropbox_hash: str) -> bool:
+        found = self._conn.execute(
+            "SELECT 1 FROM files WHERE dropbox_hash = ? LIMIT 1", (dropbox_hash,)
+        ).fetchone()
+        return bool(found)
+
+    def mark_downloaded(self, local_path: str, dropbox_path: str, dropbox_hash: str):
+        """A fresh download starts over, any previous extraction state is dropped."""
+        local_path = os.path.abspath(local_path)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO files (local_path, dropbox_path, dropbox_hash, state, "
+                "updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (local_path) DO UPDATE SET "
+                "dropbox_path = excluded.dropbox_path, "
+                "dropbox_hash = excluded.dropbox_hash, "
+                "state = excluded.state, updated_at = excluded.updated_at",
+                (local_path, dropbox_path, dropbox_hash, DOWNLOADED, time.time()),
+            )
+
+    def import_downloaded(self, dropbox_hashes: Iterable[str]):
+        """Hashes from the `.downloaded_files` cache, which had no paths."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO files (dropbox_hash, state, updated_at) VALUES (?, ?, ?)",
+                [(dropbox_hash, DOWNLOADED, now) for dropbox_hash in dropbox_hashes],
+            )
+
+    def backfill_dropbox_paths(self, paths: Iterable[Tuple[str, str]]):
+        """(local path, Dropbox path) of files downloaded before paths were kept."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO files (local_path, dropbox_path, state, updated_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (local_path) DO UPDATE SET "
+                "dropbox_path = excluded.dropbox_path, updated_at = excluded.updated_at",
+                [
+                    (os.path.abspath(local_path), dropbox_path, DOWNLOADED, now)
+                    for local_path, dropbox_path in paths
+                ],
+            )
+
+    def links(self, local_paths: List[str]) -> Dict[str, Link]:
+        """Dropbox path and cached temporary link of each known local file."""
+        local_paths = [os.path.abspath(local_path) for local_path in local_paths]
+        found: Dict[str, Link] = {}
+        for start in range(0, len(local_paths), MAX_PARAMS):
+            chunk = local_paths[start : start + MAX_PARAMS]
+            cursor = self._conn.execute(
+                "SELECT local_path, dropbox_path, link, link_expires_at FROM files "
+                f"WHERE local_path IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            )
+            for local_path, *link in cursor:
+                found[local_path] = Link(*link)
+        return found
+
+    def set_links(self, links: Iterable[Tuple[str, str, float]]):
+        """Caches (local path, link, expiry) of freshly generated temporary links."""
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "UPDATE files SET link = ?, link_expires_at = ?, updated_at = ? "
+                "WHERE local_path = ?",
+                [
+                    (link, expires_at, now, os.path.abspath(local_path))
+                    for local_path, link, expires_at in links
+                ],
+            )
+
+    # Extraction
+
+    def is_processed(self, filepath: str) -> bool:
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        row = self._conn.execute(
+            "SELECT mtime, size, state FROM files WHERE local_path = ?", (filepath,)
+        ).fetchone()
+        if row == (stat.st_mtime, stat.st_size, PROCESSED):
+            return True
+
+        content_hash = sha256_of_file(filepath)
+        found = self._conn.execute(
+            "SELECT 1 FROM files WHERE sha256 = ? AND state = ? LIMIT 1",
+            (content_hash, PROCESSED),
+        ).fetchone()
+        if found:
+            self._set_state(filepath, stat, content_hash, PROCESSED)
+        return bool(found)
+
+    def mark_processed(self, filepath: str):
+        self._set_state(
+            filepath, os.stat(filepath), sha256_of_file(filepath), PROCESSED
+        )
+
+    def mark_processed_many(self, filepaths: Iterable[str]):
+        for filepath in filepaths:
+            self.mark_processed(filepath)
+
+    def mark_failed(self, filepath: str):
+        """Kept for inspection, failed files are extracted again on the next run."""
+        self._set_state(filepath, os.stat(filepath), sha256_of_file(filepath), FAILED)
+
+    def count(self, state: str) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM files WHERE state = ?", (state,)
+        ).fetchone()[0]
+
+    def seed(self, filepaths: Iterable[str]):
+        """Marks files already present in the output, from before the manifest existed."""
+        filepaths = [filepath for filepath in filepaths if os.path.exists(filepath)]
+        log.info(f"Seeding manifest with {len(filepaths)} processed files.")
+        self.mark_processed_many(filepaths)
+
+    def import_index(self, filepath: str):
+        """Processed files from the `processed.sqlite` index the manifest replaces."""
+        if not os.path.exists(filepath):
+            return
+        index = sqlite3.connect(filepath)
+        try:
+            rows = index.execute(
+                "SELECT path, mtime, size, content_hash FROM processed"
+            ).fetchall()
+        finally:
+            index.close()
+        log.info(f"Importing {len(rows)} processed files from {filepath}.")
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO files "
+                "(local_path, mtime, size, sha256, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (os.path.abspath(path), mtime, size, content_hash, PROCESSED, now)
+                    for path, mtime, size, content_hash in rows
+                ],
+            )
+
+    def _set_state(
+        self, filepath: str, stat: os.stat_result, content_hash: str, state: str
+    ):
+        filepath = os.path.abspath(filepath)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO files (local_path, mtime, size, sha256, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (local_path) DO UPDATE SET mtime = excluded.mtime, "
+                "size = excluded.size, sha256 = excluded.sha256, "
+                "state = excluded.state, updated_at = excluded.updated_at",
+                (
+                    filepath,
+                    stat.st_mtime,
+                    stat.st_size,
+                    content_hash,
+                    state,
+                    time.time(),
+                ),
+            )
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,179 @@
+"""Vectorised normalisation and validation of a frame of extracted NfeCampos"""
+
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+ISO_DATE = r"\d{4}-\d{2}-\d{2}"
+DATE_FIELD = rf"^(?:{ISO_DATE}|\[{ISO_DATE}(?:, {ISO_DATE})*\])$"
+CNPJ_WEIGHTS = np.array([6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2])
+# chave de acesso weights, 2 to 9 repeating from the rightmost of the 43 digits
+CHAVE_WEIGHTS = np.array([2, 3, 4, 5, 6, 7, 8, 9] * 6)[:43][::-1]
+# validated fields optional in NfeCampos, an invalid one is blanked, not the row dropped
+BLANKABLE_FIELDS = ["chave_de_acesso", "num_nf"]
+
+
+class Normalized(NamedTuple):
+    frame: pd.DataFrame
+    errors: pd.DataFrame  # one boolean column per validated field
+
+    @property
+    def invalid(self) -> pd.Series:
+        """Rows with at least one invalid field."""
+        return self.errors.any(axis=1)
+
+    @property
+    def invalid_required(self) -> pd.Series:
+        """Rows with an invalid field that can't be left empty."""
+        return self.errors.drop(columns=BLANKABLE_FIELDS, errors="ignore").any(axis=1)
+
+
+def only_digits(series: pd.Series) -> pd.Series:
+    return series.astype("string").str.replace(r"[^0-9]", "", regex=True).fillna("")
+
+
+def digit_matrix(series: pd.Series, width: int) -> np.ndarray:
+    """Strings of exactly `width` digits as an (n, width) integer matrix."""
+    data = "".join(series.tolist()).encode("ascii")
+    return (np.frombuffer(data, dtype=np.uint8) - ord("0")).reshape(-1, width)
+
+
+def mod11(total: np.ndarray) -> np.ndarray:
+    remainder = total % 11
+    return np.where(remainder < 2, 0, 11 - remainder)
+
+
+def valid_cnpj_digits(digits: pd.Series) -> pd.Series:
+    """Check digits of 14 digit CNPJs, False for anything else."""
+    valid = pd.Series(False, index=digits.index)
+    candidates = digits[digits.str.len() == 14]
+    if candidates.empty:
+        return valid
+    matrix = digit_matrix(candidates, 14)
+    first = mod11(matrix[:, :12] @ CNPJ_WEIGHTS[1:])
+    second = mod11(matrix[:, :12] @ CNPJ_WEIGHTS[:12] + first * CNPJ_WEIGHTS[12])
+    repeated = (matrix == matrix[:, :1]).all(axis=1)
+    valid[candidates.index] = (
+        (first == matrix[:, 12]) & (second == matrix[:, 13]) & ~repeated
+    )
+    return valid
+
+
+def valid_chave_digits(digits: pd.Series) -> pd.Series:
+    """Check digit of 44 digit chaves de acesso, False for anything else."""
+    valid = pd.Series(False, index=digits.index)
+    candidates = digits[digits.str.len() == 44]
+    if candidates.empty:
+        return valid
+    matrix = digit_matrix(candidates, 44)
+    valid[candidates.index] = mod11(matrix[:, :43] @ CHAVE_WEIGHTS) == matrix[:, 43]
+    return valid
+
+
+def normalize_dates(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """
+    ISO or dd/mm/aaaa dates to ISO, lists of due dates item by item. Also returns
+    the invalid mask, which includes impossible dates.
+    """
+    text = series.astype("string").str.strip()
+    iso = pd.to_datetime(text, format="%Y-%m-%d", errors="coerce")
+    brazilian = pd.to_datetime(
+        text.where(iso.isna()), format="%d/%m/%Y", errors="coerce"
+    )
+    single = iso.fillna(brazilian)
+    dates = single.dt.strftime("%Y-%m-%d").astype("string")
+
+    lists = text.str.startswith("[").fillna(False)
+    if lists.any():
+        items = text[lists].str.replace(
+            r"(\d{2})/(\d{2})/(\d{4})", r"\3-\2-\1", regex=True
+        )
+        first = pd.to_datetime(
+            items.str.extract(f"({ISO_DATE})", expand=False),
+            format="%Y-%m-%d",
+            errors="coerce",
+        )
+        valid_items = items.str.match(DATE_FIELD).fillna(False) & first.notna()
+        dates[lists] = items.where(valid_items)
+
+    invalid = dates.isna()
+    return dates.where(~invalid, text), invalid
+
+
+def format_cnpj_matrix(matrix: np.ndarray) -> np.ndarray:
+    """XX.XXX.XXX/XXXX-XX from the rows of an (n, 14) digit matrix."""
+    formatted = np.empty((len(matrix), 18), dtype=np.uint8)
+    digit_columns = [0, 1, 3, 4, 5, 7, 8, 9, 11, 12, 13, 14, 16, 17]
+    formatted[:, digit_columns] = matrix + ord("0")
+    formatted[:, [2, 6]] = ord(".")
+    formatted[:, 10] = ord("/")
+    formatted[:, 15] = ord("-")
+    return formatted.view("S18").ravel().astype(str)
+
+
+def normalize_cnpjs(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Formats valid CNPJs and CPFs, invalid when a CNPJ fails its check digits."""
+    digits = only_digits(series)
+    valid_cnpj = valid_cnpj_digits(digits)
+    is_cpf = digits.str.len() == 11
+    formatted = series.astype("string")
+    if valid_cnpj.any():
+        matrix = digit_matrix(digits[valid_cnpj], 14)
+        formatted[valid_cnpj] = format_cnpj_matrix(matrix)
+    if is_cpf.any():
+        formatted[is_cpf] = digits[is_cpf].str.replace(
+            r"^(\d{3})(\d{3})(\d{3})(\d{2})$", r"\1.\2.\3-\4", regex=True
+        )
+    return formatted, ~(valid_cnpj | is_cpf)
+
+
+def normalize_chaves(series: pd.Series) -> tuple[pd.Series, pd.Series]:
+    """Digits only, empty chaves are allowed, others need a valid check digit."""
+    digits = only_digits(series)
+    empty = digits == ""
+    valid = valid_chave_digits(digits) | empty
+    return digits.where(~empty), ~valid
+
+
+def to_number(series: pd.Series) -> pd.Series:
+    """Numbers and strings either as 1234.56 or as the brazilian R$ 1.234,56."""
+    numbers = pd.to_numeric(series, errors="coerce").astype("float64")
+    pending = numbers.isna() & series.notna()
+    if pending.any():
+        text = series[pending].astype("string").str.strip()
+        text = text.str.replace(r"^R\$\s*", "", regex=True)
+        text = text.str.replace(".", "", regex=False).str.replace(",", ".", regex=False)
+        parsed = pd.to_numeric(text, errors="coerce")
+        numbers[pending] = parsed.to_numpy(dtype="float64", na_value=np.nan)
+    return numbers.astype("Float64")
+
+
+def normalize(df: pd.DataFrame) -> Normalized:
+    """
+    Normalises the fields of every row at once: dates to ISO, CNPJ formatting and
+    check digits, chave de acesso check digit, `valor` and `num_nf` to numbers.
+    Returns the normalised copy and the per row error mask.
+    """
+    frame = df.copy()
+    errors = pd.DataFrame(index=df.index)
+
+    if "data" in frame:
+        frame["data"], errors["data"] = normalize_dates(frame["data"])
+    if "cnpj_do_vendedor" in frame:
+        frame["cnpj_do_vendedor"], errors["cnpj_do_vendedor"] = normalize_cnpjs(
+            frame["cnpj_do_vendedor"]
+        )
+    if "chave_de_acesso" in frame:
+        frame["chave_de_acesso"], errors["chave_de_acesso"] = normalize_chaves(
+            frame["chave_de_acesso"]
+        )
+    if "valor" in frame:
+        frame["valor"] = to_number(frame["valor"])
+        errors["valor"] = frame["valor"].isna()
+    if "num_nf" in frame:
+        num_nf = to_number(frame["num_nf"])
+        errors["num_nf"] = num_nf.notna() & (num_nf % 1 != 0)
+        frame["num_nf"] = num_nf.where(~errors["num_nf"]).astype("Int64")
+
+    return Normalized(frame, errors.fillna(True).astype(bool))
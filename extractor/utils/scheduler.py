@@ -0,0 +1,170 @@
+"""Bounded-concurrency scheduler that keeps LLM calls under provider rate limits"""
+
+import asyncio
+import contextvars
+import itertools
+import time
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    NamedTuple,
+    Tuple,
+)
+
+from loguru import logger as log
+
+
+class RateLimiter:
+    """
+    Token bucket refilled continuously so that at most `per_minute` units are spent
+    in any 60 s window. `headroom` keeps usage just under the provider limit.
+    `burst` caps the bucket below a minute's worth, for per second limits.
+    """
+
+    def __init__(
+        self, per_minute: float, headroom: float = 0.9, burst: float | None = None
+    ):
+        self.rate = per_minute * headroom / 60
+        self.capacity = per_minute * headroom if burst is None else burst
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    async def acquire(self, amount: float = 1):
+        # A request bigger than the whole bucket would wait forever, let it drain it
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class _Job:
+    """Limiters of the job running in this context, its first call paid by its cost."""
+
+    def __init__(self, requests: RateLimiter, tokens: RateLimiter):
+        self.requests = requests
+        self.tokens = tokens
+        self.prepaid = True
+
+
+_current_job: contextvars.ContextVar[_Job | None] = contextvars.ContextVar(
+    "current_job", default=None
+)
+
+
+async def acquire_call(estimate_tokens: Callable[[], float]):
+    """
+    Paces an API call of the scheduled job running in this context. Its first call
+    was paid when the job was scheduled, the extra ones (chunks, repairs, model
+    escalations, retries) wait on the same limiters, `estimate_tokens` is only
+    called for those. Calls outside a scheduled job are not paced.
+    """
+    job = _current_job.get()
+    if job is None:
+        return
+    if job.prepaid:
+        job.prepaid = False
+        return
+    await job.requests.acquire(1)
+    await job.tokens.acquire(estimate_tokens())
+
+
+class Scheduler:
+    """
+    Runs jobs through a fixed pool of workers, cheapest jobs first, pacing the
+    requests and tokens spent per minute with a `RateLimiter` each. Calls a job
+    makes beyond its first go through `acquire_call` and the same limiters.
+    """
+
+    def __init__(
+        self,
+        max_workers: int,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        headroom: float = 0.9,
+    ):
+        self.max_workers = max_workers
+        self.requests = RateLimiter(requests_per_minute, headroom)
+        self.tokens = RateLimiter(tokens_per_minute, headroom)
+
+    async def map(
+        self,
+        worker: Callable[..., Awaitable[Any]],
+        jobs: Iterable[Tuple[int, Tuple]] | AsyncIterable[Tuple[int, Tuple]],
+        queue_size: int = 0,
+    ) -> AsyncIterator[Any]:
+        """
+        Apply `worker(*args)` to every `(cost_in_tokens, args)` job and yield the
+        results in completion order. Jobs may come from an async iterable, in that
+        case a `queue_size` bounds how many of them wait for a worker, and the
+        cheapest-first ordering applies within that window.
+        """
+        queue: asyncio.PriorityQueue = asyncio.PriorityQueue(queue_size)
+        results: asyncio.Queue = asyncio.Queue()
+        counter = itertools.count()  # tie breaker, args are not comparable
+
+        async def produce():
+            submitted = 0
+            try:
+                if isinstance(jobs, AsyncIterable):
+                    async for cost, args in jobs:
+                        await queue.put((cost, next(counter), args))
+                        submitted += 1
+                else:
+                    for cost, args in jobs:
+                        await queue.put((cost, next(counter), args))
+                        submitted += 1
+            except Exception as e:
+                log.exception(f"Failed to produce jobs: {e}")
+            finally:
+                results.put_nowait(_Exhausted(submitted))
+
+        async def consume():
+            while True:
+                cost, _, args = await queue.get()
+                try:
+                    await self.requests.acquire(1)
+                    await self.tokens.acquire(cost)
+                    # tasks the worker spawns copy the context, sharing the job
+                    _current_job.set(_Job(self.requests, self.tokens))
+                    await results.put(await worker(*args))
+                except Exception as e:
+                    log.exception(f"Scheduled job failed: {e}")
+                    await results.put(None)
+                finally:
+                    queue.task_done()
+
+        log.info(f"Scheduling jobs on {self.max_workers} workers.")
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(consume()) for _ in range(self.max_workers)]
+        received, expected = 0, None
+        try:
+            while expected is None or received < expected:
+                result = await results.get()
+                if isinstance(result, _Exhausted):
+                    expected = result.total
+                    continue
+                received += 1
+                yield result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        log.info(f"Finished {received} jobs.")
+
+
+class _Exhausted(NamedTuple):
+    total: int
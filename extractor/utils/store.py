@@ -0,0 +1,147 @@
+"""Append-only SQLite store for extracted NFes, with a lazy sorted read API"""
+
+import csv
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, Iterator, List
+
+import pandas as pd
+from loguru import logger as log
+
+
+class NfeStore:
+    """
+    Rows are buffered and appended in a single transaction per flush, so a crash
+    never leaves a half written output. Each row is kept as JSON next to the few
+    columns used for sorting and filtering, which lets the schema evolve freely.
+    """
+
+    def __init__(
+        self, filepath: str, batch_size: int = 50, flush_interval_sec: float = 5
+    ):
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.flush_interval_sec = flush_interval_sec
+        self._buffer: List[Dict[str, Any]] = []
+        self._flushed_at = time.monotonic()
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        self._conn = sqlite3.connect(filepath)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nfe ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "data TEXT, input_filepath TEXT, inserted_at TEXT, row TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS nfe_data ON nfe (data)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS nfe_inserted_at ON nfe (inserted_at)"
+        )
+        self._conn.commit()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM nfe").fetchone()[0]
+
+    @property
+    def buffered(self) -> int:
+        return len(self._buffer)
+
+    def write(self, row: Dict[str, Any]):
+        self._buffer.append(row)
+        elapsed = time.monotonic() - self._flushed_at
+        if len(self._buffer) >= self.batch_size or elapsed >= self.flush_interval_sec:
+            self.flush()
+
+    def write_many(self, rows: Iterable[Dict[str, Any]]):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if not self._buffer:
+            return
+        values = [
+            (
+                None if row.get("data") is None else str(row["data"]),
+                row.get("input_filepath"),
+                str(row.get("inserted_at")),
+                json.dumps(row, default=str, ensure_ascii=False),
+            )
+            for row in self._buffer
+        ]
+        with self._conn:
+            self._conn.executemany(
+                "INSERT INTO nfe (data, input_filepath, inserted_at, row) "
+                "VALUES (?, ?, ?, ?)",
+                values,
+            )
+        self._buffer.clear()
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def iter_rows(
+        self, order_by: str = "data", descending: bool = True, latest_only=False
+    ) -> Iterator[Dict[str, Any]]:
+        """Stream rows sorted by one of the indexed columns, one at a time."""
+        if order_by not in ("data", "inserted_at", "id"):
+            raise ValueError(f"Can not sort by {order_by=}")
+        self.flush()
+        query = "SELECT row FROM nfe"
+        if latest_only:
+            query += " WHERE inserted_at = (SELECT MAX(inserted_at) FROM nfe)"
+        query += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}, id"
+        for (row,) in self._conn.execute(query):
+            yield json.loads(row)
+
+    def read(self, chunksize: int = 1000, **kwargs) -> Iterator[pd.DataFrame]:
+        """Lazy sorted view, as DataFrames of at most `chunksize` rows."""
+        chunk = []
+        for row in self.iter_rows(**kwargs):
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pd.DataFrame(chunk)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk)
+
+    def read_frame(self, **kwargs) -> pd.DataFrame:
+        frames = list(self.read(**kwargs))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def input_filepaths(self) -> set[str]:
+        self.flush()
+        query = "SELECT DISTINCT input_filepath FROM nfe"
+        return {filepath for (filepath,) in self._conn.execute(query) if filepath}
+
+    def export_csv(self, filepath: str):
+        """Rewrites the CSV export atomically, sorted by data like it always was."""
+        if not len(self):
+            return
+        fieldnames: Dict[str, None] = {}
+        for row in self.iter_rows(order_by="id"):
+            fieldnames.update(dict.fromkeys(row))
+        tmp_filepath = f"{filepath}.tmp"
+        with open(tmp_filepath, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(fieldnames))
+            writer.writeheader()
+            writer.writerows(self.iter_rows())
+        os.replace(tmp_filepath, filepath)
+        log.info(f"Exported {len(self)} rows to {filepath}")
+
+    def import_csv(self, filepath: str):
+        """One time migration of a legacy nfe.csv into an empty store."""
+        if len(self) or not os.path.exists(filepath):
+            return
+        df = pd.read_csv(filepath)
+        log.info(f"Importing {len(df)} rows from {filepath}")
+        self.write_many(df.astype(object).where(df.notna(), None).to_dict("records"))
+        self.flush()
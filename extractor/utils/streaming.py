@@ -0,0 +1,54 @@
+"""Incremental parsing of a JSON object that arrives in fragments"""
+
+import json
+from typing import Any, List, Tuple
+
+
+class ObjectStreamParser:
+    """
+    Fed the fragments of a JSON object as a model streams them, returns each top
+    level `key: value` pair as soon as its value is complete. Raises ValueError
+    when a pair is not valid JSON.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.position = 0  # next character to scan
+        self.start = 0  # start of the pair being read
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, fragment: str) -> List[Tuple[str, Any]]:
+        self.buffer += fragment
+        pairs: List[Tuple[str, Any]] = []
+        for index in range(self.position, len(self.buffer)):
+            char = self.buffer[index]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.depth += 1
+                if self.depth == 1:
+                    self.start = index + 1
+            elif char in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    pairs += self._pair(index)
+            elif char == "," and self.depth == 1:
+                pairs += self._pair(index)
+                self.start = index + 1
+        self.position = len(self.buffer)
+        return pairs
+
+    def _pair(self, end: int) -> List[Tuple[str, Any]]:
+        segment = self.buffer[self.start : end].strip()
+        if not segment:
+            return []
+        return list(json.loads("{" + segment + "}").items())
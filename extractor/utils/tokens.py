@@ -0,0 +1,36 @@
+"""Token accounting with memoized tiktoken encoders"""
+
+import asyncio
+import functools
+from typing import List
+
+import tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str) -> tiktoken.Encoding:
+    """`encoding_for_model` loads the BPE ranks, do it once per model."""
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+
+def count_tokens_batch(texts: List[str], model: str, num_threads: int = 8) -> List[int]:
+    """Counts many texts at once, tiktoken spreads the encoding across threads."""
+    encoded = get_encoding(model).encode_batch(
+        texts, num_threads=num_threads, disallowed_special=()
+    )
+    return [len(tokens) for tokens in encoded]
+
+
+async def acount_tokens(text: str, model: str) -> int:
+    """`count_tokens` off the event loop, tiktoken releases the GIL while encoding."""
+    return await asyncio.to_thread(count_tokens, text, model)
+
+
+async def acount_tokens_batch(
+    texts: List[str], model: str, num_threads: int = 8
+) -> List[int]:
+    return await asyncio.to_thread(count_tokens_batch, texts, model, num_threads)
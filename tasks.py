@@ -7,3 +7,10 @@ from extractor.nfe import run
 @task(default=True)
 def nfe(c):
     asyncio.run(run())
+
+
+@task
+def batch(c, command="run"):
+    from extractor.nfe.batch import main
+
+    main(command)
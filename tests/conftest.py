@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+# extractor.config reads these at import time, the tests never reach the APIs
+for name in (
+    "OPENAI_API_KEY",
+    "DROPBOX_ACCESS_TOKEN",
+    "AIRTABLE_PERSONAL_ACCESS_TOKEN",
+):
+    os.environ.setdefault(name, "test")
+
+# a valid answer of the model to NfeCampos, without the input_filepath
+ANSWER = {
+    "data": "2024-01-01",
+    "categoria": "material de escritorio",
+    "num_nf": 1,
+    "valor": 10.0,
+    "fornecedor": "Papelaria",
+    "cnpj_do_vendedor": "11.222.333/0001-81",
+    "forma": None,
+    "numero_de_parcelas": None,
+    "chave_de_acesso": None,
+}
+
+
+class WhitespaceEncoding:
+    """One token per word, so token counts need no BPE download."""
+
+    def encode(self, text, **kwargs):
+        return text.split()
+
+    def encode_batch(self, texts, **kwargs):
+        return [text.split() for text in texts]
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def offline_tokens(monkeypatch):
+    import tiktoken
+
+    from extractor.utils import tokens
+
+    tokens.get_encoding.cache_clear()
+    monkeypatch.setattr(
+        tiktoken, "encoding_for_model", lambda model: WhitespaceEncoding()
+    )
+    yield
+    tokens.get_encoding.cache_clear()
@@ -0,0 +1,24 @@
+import pandas as pd
+
+from extractor.airtable import normalize_incoming
+
+
+def test_normalize_incoming_blanks_optional_and_drops_required():
+    df = pd.DataFrame(
+        {
+            "data": ["2024-01-01", "01/02/2024", "2024-13-01"],
+            "valor": ["10", "R$ 1.234,56", "1"],
+            "num_nf": [1, 2.5, 3],
+            "cnpj_do_vendedor": ["11222333000181"] * 3,
+            "chave_de_acesso": ["123", "", None],
+            "input_filepath": ["a.pdf", "b.pdf", "c.pdf"],
+        }
+    )
+    rows = normalize_incoming(df).to_dict("records")
+
+    assert [row["input_filepath"] for row in rows] == ["a.pdf", "b.pdf"]
+    assert pd.isna(rows[0]["chave_de_acesso"])
+    assert rows[0]["num_nf"] == 1
+    assert pd.isna(rows[1]["num_nf"])
+    assert rows[1]["data"] == "2024-02-01"
+    assert rows[1]["cnpj_do_vendedor"] == "11.222.333/0001-81"
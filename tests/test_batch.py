@@ -0,0 +1,114 @@
+import json
+import re
+
+import pandas as pd
+import pytest
+
+from extractor import nfe
+from extractor.nfe import batch
+from extractor.utils.cache import ExtractionCache
+from extractor.utils.manifest import PROCESSED, Manifest
+from extractor.utils.store import NfeStore
+from tests.conftest import ANSWER
+
+
+class StubBackend(batch.BatchBackend):
+    """Answers every request as soon as it is submitted, done on the second poll."""
+
+    def __init__(self):
+        self.batches = {}
+
+    def submit(self, filepath):
+        with open(filepath, encoding="utf-8") as file:
+            requests = [json.loads(line) for line in file]
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = {"requests": requests, "polls": 0}
+        return batch_id
+
+    def status(self, batch_id):
+        stub = self.batches[batch_id]
+        stub["polls"] += 1
+        status = "completed" if stub["polls"] > 1 else "in_progress"
+        return {"id": batch_id, "status": status, "output_file_id": batch_id}
+
+    def results(self, batch):
+        for request in self.batches[batch["id"]]["requests"]:
+            body = request["body"]
+            content = body["messages"][-1]["content"]
+            input_filepath = re.search(r"input_filepath: (\S+)", content).group(1)
+            properties = body["functions"][0]["parameters"]["properties"]
+            answer = {**ANSWER, "input_filepath": input_filepath}
+            if "bad" in input_filepath:
+                answer["cnpj_do_vendedor"] = "55.295.125/0001-88"  # the buyer
+            arguments = {
+                name: value for name, value in answer.items() if name in properties
+            }
+            function_call = {
+                "name": body["function_call"]["name"],
+                "arguments": json.dumps(arguments),
+            }
+            yield {
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "choices": [{"message": {"function_call": function_call}}]
+                    },
+                },
+            }
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch, offline_tokens):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    (input_dir / "nota1.txt").write_text("NOTA FISCAL 1 papelaria VALOR TOTAL 10,00")
+    (input_dir / "nota2.txt").write_text("NOTA FISCAL 2 papelaria VALOR TOTAL 10,00")
+    (input_dir / "bad.txt").write_text("NOTA FISCAL 3 papelaria VALOR TOTAL 10,00")
+    # beyond the window of every model
+    (input_dir / "long.txt").write_text("palavra " * 200_000)
+
+    monkeypatch.setattr(nfe, "NFES_INPUT", str(input_dir))
+    monkeypatch.setattr(nfe, "NFES_OUTPUT", str(tmp_path / "nfe.csv"))
+    monkeypatch.setattr(nfe, "NFES_STORE", str(tmp_path / "nfe.sqlite"))
+    monkeypatch.setattr(nfe, "MANIFEST_FILE", str(tmp_path / "manifest.sqlite"))
+    monkeypatch.setattr(
+        nfe, "EXTRACTION_CACHE", ExtractionCache(str(tmp_path / "cache"), 1, 1)
+    )
+    monkeypatch.setattr(batch, "BATCH_DIR", str(tmp_path / "batches"))
+    monkeypatch.setattr(batch, "BATCH_STATE", str(tmp_path / "batches" / "state.json"))
+    monkeypatch.setattr(batch, "POLL_INTERVAL_SEC", 0)
+    return tmp_path
+
+
+def test_submit_and_collect(workdir):
+    backend = StubBackend()
+    start_of_process = pd.Timestamp.now()
+    with NfeStore(str(workdir / "nfe.sqlite")) as store, Manifest(
+        str(workdir / "manifest.sqlite")
+    ) as index:
+        assert batch.submit(backend, store, index, start_of_process) == 3
+        assert len(batch.load_state()["requests"]) == 3
+
+        assert batch.collect(backend, store, index, start_of_process) == 2
+        assert len(store) == 2
+        assert index.count(PROCESSED) == 2
+        assert batch.load_state()["requests"] == {}
+
+        # the long document was skipped without aborting, the invalid answer
+        # with the buyer CNPJ is left to `run`, the others are done
+        assert not index.is_processed(str(workdir / "input" / "long.txt"))
+        assert not index.is_processed(str(workdir / "input" / "bad.txt"))
+        assert batch.submit(backend, store, index, start_of_process) == 1
+
+
+def test_one_inserted_at_per_run(workdir, monkeypatch):
+    monkeypatch.setattr(batch, "MAX_REQUESTS_PER_BATCH", 1)
+    backend = StubBackend()
+    batch.main("run", backend)
+
+    assert len(backend.batches) == 3
+    with NfeStore(str(workdir / "nfe.sqlite")) as store:
+        rows = store.read_frame()
+    assert len(rows) == 2
+    assert rows["inserted_at"].nunique() == 1
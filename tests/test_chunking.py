@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+from extractor import nfe
+from extractor.loader import PAGE_SEPARATOR
+from extractor.nfe import chunking
+from tests.conftest import ANSWER
+
+MODEL = "gpt-4-turbo-preview"
+
+
+def test_keeps_the_first_and_the_relevant_pages():
+    document = PAGE_SEPARATOR.join(
+        ["Papelaria Central", "Termos e condicoes", " ", "VALOR TOTAL 10,00"]
+    )
+    pages = chunking.split_pages(document)
+    assert len(pages) == 3
+    assert chunking.filter_pages(pages) == ["Papelaria Central", "VALOR TOTAL 10,00"]
+
+
+def test_packs_pages_and_cuts_the_large_ones(offline_tokens):
+    pages = ["um dois", "tres quatro", "cinco " * 7]
+    chunks = chunking.make_chunks(pages, max_tokens=5, model=MODEL)
+    assert chunks == [
+        f"um dois{PAGE_SEPARATOR}tres quatro",
+        "cinco cinco cinco cinco cinco",
+        "cinco cinco",
+    ]
+
+
+def test_merge_partials():
+    partials = [
+        {"data": "2024-01-05", "valor": 100.0, "categoria": "papelaria", "forma": ""},
+        {
+            "data": "[2024-02-05, 2024-03-05]",
+            "valor": 300.0,
+            "categoria": "papelaria ",
+        },
+        {"data": "2024-01-05", "valor": None, "categoria": "limpeza", "forma": "PIX"},
+    ]
+    assert chunking.merge_partials(partials) == {
+        "data": "[2024-02-05, 2024-03-05]",
+        "valor": 300.0,
+        "categoria": "papelaria, limpeza",
+        "forma": "PIX",
+    }
+
+
+def test_invalid_merged_fields_are_repaired(offline_tokens, monkeypatch):
+    document = PAGE_SEPARATOR.join(["Papelaria Central", "CNPJ do emitente"])
+    repair_prompts = []
+
+    async def extract_chunk(chunk, input_filepath, schema, temperature):
+        if "CNPJ" in chunk:
+            # the buyer CNPJ, and a chave too short
+            return {"cnpj_do_vendedor": "55.295.125/0001-88", "chave_de_acesso": "1"}
+        return {**ANSWER, "cnpj_do_vendedor": None}
+
+    async def completion_with_backoff(async_timeout, **kwargs):
+        repair_prompts.append(kwargs["messages"][1]["content"])
+        arguments = {"cnpj_do_vendedor": ANSWER["cnpj_do_vendedor"]}
+        arguments["chave_de_acesso"] = "still invalid"
+        function_call = {
+            "name": kwargs["function_call"]["name"],
+            "arguments": json.dumps(arguments),
+        }
+        return {"choices": [{"message": {"function_call": function_call}}]}
+
+    monkeypatch.setattr(nfe, "CHUNK_TOKENS", 3)
+    monkeypatch.setattr(nfe, "extract_chunk", extract_chunk)
+    monkeypatch.setattr(nfe.llm, "completion_with_backoff", completion_with_backoff)
+    result = asyncio.run(nfe.process_long_nfe_document(document, "long.pdf"))
+
+    assert len(repair_prompts) == 1
+    assert "CNPJ do emitente" in repair_prompts[0]
+    assert result.cnpj_do_vendedor == ANSWER["cnpj_do_vendedor"]
+    assert result.chave_de_acesso is None
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+
+from extractor.drive import download
+from extractor.utils.manifest import Manifest
+
+
+class StubDropbox:
+    def __init__(self, missing=()):
+        self.missing = set(missing)
+        self.requested = []
+
+    def files_get_temporary_link(self, path):
+        self.requested.append(path)
+        if path in self.missing:
+            raise RuntimeError(f"path/not_found {path}")
+        return SimpleNamespace(link=f"https://dl.example{path}")
+
+
+@pytest.fixture
+def manifest(tmp_path, monkeypatch):
+    monkeypatch.setattr(download, "INPUT_FOLDER", tmp_path / "input")
+    monkeypatch.setattr(download, "FOLDER_PATH", "/notas")
+    with Manifest(str(tmp_path / "manifest.sqlite")) as manifest:
+        yield manifest
+
+
+def test_links_of_files_without_a_dropbox_path(manifest):
+    manifest.mark_downloaded(
+        str(download.INPUT_FOLDER / "synced.pdf"), "/notas/sub/synced.pdf", "1" * 64
+    )
+    # legacy rows only have the hash, other files no row at all
+    manifest.import_downloaded(["2" * 64])
+    dbx = StubDropbox(missing={"/notas/gone.pdf"})
+    filenames = ["synced.pdf", "legacy.pdf", "gone.pdf"]
+
+    urls = download.get_download_urls(manifest, filenames, dbx=dbx)
+    assert urls == {
+        "synced.pdf": "https://dl.example/notas/sub/synced.pdf",
+        "legacy.pdf": "https://dl.example/notas/legacy.pdf",
+    }
+    assert sorted(dbx.requested) == [
+        "/notas/gone.pdf",
+        "/notas/legacy.pdf",
+        "/notas/sub/synced.pdf",
+    ]
+
+    # the backfilled path and its link are cached, the missing file is retried
+    dbx.requested.clear()
+    assert download.get_download_urls(manifest, filenames, dbx=dbx) == urls
+    assert dbx.requested == ["/notas/gone.pdf"]
+    link = manifest.links([str(download.INPUT_FOLDER / "legacy.pdf")])
+    assert [value.dropbox_path for value in link.values()] == ["/notas/legacy.pdf"]
@@ -0,0 +1,84 @@
+import asyncio
+import json
+
+import pytest
+
+from extractor import nfe
+from tests.conftest import ANSWER
+
+BLANKS = {**ANSWER, "forma": "", "chave_de_acesso": "", "input_filepath": "a.txt"}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Streams BLANKS in small fragments, records every call."""
+    calls = []
+
+    async def stream_function_arguments(async_timeout, **kwargs):
+        calls.append(kwargs)
+        text = json.dumps(BLANKS)
+        for start in range(0, len(text), 7):
+            yield text[start : start + 7]
+
+    async def completion_with_backoff(async_timeout, **kwargs):
+        calls.append(kwargs)
+        raise AssertionError("no repair expected")
+
+    monkeypatch.setattr(nfe.llm, "stream_function_arguments", stream_function_arguments)
+    monkeypatch.setattr(nfe.llm, "completion_with_backoff", completion_with_backoff)
+    return calls
+
+
+def test_blank_nullable_fields_are_empty_not_invalid(calls):
+    extracted = asyncio.run(
+        nfe.extract_fields(nfe.NfeCampos, "nota", "gpt-3.5-turbo-0125")
+    )
+
+    assert len(calls) == 1
+    assert extracted["chave_de_acesso"] is None
+    assert extracted["forma"] is None
+
+
+@pytest.mark.parametrize(
+    "name, value, valid",
+    [
+        ("chave_de_acesso", "", True),
+        ("chave_de_acesso", "123", False),
+        ("cnpj_do_vendedor", "", False),
+    ],
+)
+def test_only_nullable_fields_may_be_blank(name, value, valid):
+    error = nfe.validate_field(name, nfe.clean_field(name, value))
+    assert (error is None) == valid
+
+
+@pytest.mark.parametrize(
+    "value, cleaned",
+    [
+        ("2024-02-29", "2024-02-29"),
+        ("05/03/2024", "2024-03-05"),
+        ("[2024-02-05, 2024-03-05]", "[2024-02-05, 2024-03-05]"),
+        # the due dates as the document writes them
+        ("[05/02/2024, 05/03/2024]", "[2024-02-05, 2024-03-05]"),
+    ],
+)
+def test_dates_are_cleaned_to_iso(value, cleaned):
+    assert nfe.clean_field("data", value) == cleaned
+    assert nfe.validate_field("data", cleaned) is None
+
+
+@pytest.mark.parametrize(
+    "value", ["2024-13-45", "2023-02-29", "[2024-01-31, 2024-02-30]", "31/02/2024"]
+)
+def test_impossible_dates_are_invalid(value):
+    assert nfe.validate_field("data", nfe.clean_field("data", value))
+
+
+def test_list_of_due_dates_is_not_repaired(calls, monkeypatch):
+    monkeypatch.setitem(BLANKS, "data", "[05/02/2024, 05/03/2024]")
+    extracted = asyncio.run(
+        nfe.extract_fields(nfe.NfeCampos, "nota", "gpt-3.5-turbo-0125")
+    )
+
+    assert len(calls) == 1
+    assert extracted["data"] == "[2024-02-05, 2024-03-05]"
@@ -0,0 +1,138 @@
+import asyncio
+import email.utils
+import time
+
+import pytest
+from aiohttp import web
+
+from extractor.config import openai
+from extractor.utils import llm
+
+MODEL = "gpt-3.5-turbo-0125"
+
+
+async def serve_chat(ports: set) -> web.AppRunner:
+    """Local OpenAI compatible server, recording the client port of each request."""
+
+    async def chat(request):
+        ports.add(request.transport.get_extra_info("peername")[1])
+        await asyncio.sleep(0.05)
+        return web.json_response(
+            {
+                "id": "chatcmpl-test",
+                "object": "chat.completion",
+                "choices": [{"message": {"role": "assistant", "content": "ok"}}],
+                "usage": {"total_tokens": 1},
+            }
+        )
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    return runner
+
+
+def test_pooled_session_reuses_connections(monkeypatch):
+    ports = set()
+
+    async def call():
+        return await llm.completion_with_backoff(
+            5, model=MODEL, messages=[{"role": "user", "content": "oi"}]
+        )
+
+    async def run():
+        runner = await serve_chat(ports)
+        port = runner.addresses[0][1]
+        # what the `[llm] api_base` setting does at import
+        monkeypatch.setattr(openai, "api_base", f"http://127.0.0.1:{port}/v1")
+        try:
+            async with llm.pooled_session(max_connections=4):
+                completions = await asyncio.gather(
+                    *(asyncio.create_task(call()) for _ in range(40))
+                )
+        finally:
+            await runner.cleanup()
+        return completions
+
+    completions = asyncio.run(run())
+    assert len(completions) == 40
+    assert all(c["choices"][0]["message"]["content"] == "ok" for c in completions)
+    assert 0 < len(ports) <= 4
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """A fresh breaker for the test, and no deadline left behind."""
+    breaker = llm.CircuitBreaker(max_failures=2, cooldown_sec=30)
+    monkeypatch.setattr(llm, "BREAKER", breaker)
+    yield breaker
+    llm.set_deadline(None)
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (openai.error.RateLimitError("slow down"), True),
+        (openai.error.RateLimitError("no credit", code="insufficient_quota"), False),
+        (openai.error.AuthenticationError("bad key", http_status=401), False),
+        (openai.error.InvalidRequestError("too long", "messages"), False),
+        (openai.error.APIError("bad gateway", http_status=502), True),
+        (openai.error.ServiceUnavailableError("overloaded", http_status=503), True),
+        (openai.error.Timeout("timed out"), True),
+        (asyncio.TimeoutError(), True),
+        (ValueError("bad answer"), False),
+    ],
+)
+def test_is_retryable(error, retryable):
+    assert llm.is_retryable(error) == retryable
+
+
+def test_get_retry_after():
+    def rate_limit(**headers):
+        return openai.error.RateLimitError("slow down", headers=headers)
+
+    retry_at = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert llm.get_retry_after(rate_limit(**{"retry-after": "2"})) == 2
+    assert llm.get_retry_after(rate_limit(**{"retry-after-ms": "1500"})) == 1.5
+    assert 25 < llm.get_retry_after(rate_limit(**{"retry-after": retry_at})) <= 30
+    assert llm.get_retry_after(rate_limit(**{"retry-after": "soon"})) is None
+    assert llm.get_retry_after(rate_limit()) is None
+
+
+def test_breaker_opens_after_errors_in_a_row(breaker):
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.open_until == 0
+
+    breaker.record_failure(retry_after=2)
+    assert breaker.open_until - time.monotonic() > 25
+    assert breaker.failures == 0
+
+
+def test_breaker_wait_stops_at_the_deadline(breaker):
+    breaker.trip(60)
+    llm.set_deadline(0.2)
+    start = time.monotonic()
+    asyncio.run(breaker.wait())
+    assert time.monotonic() - start < 1
+
+
+def test_retries_stop_at_the_deadline(breaker, monkeypatch):
+    calls = []
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        raise openai.error.RateLimitError("slow down", headers={"retry-after": "60"})
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    llm.set_deadline(0.3)
+    start = time.monotonic()
+    with pytest.raises(TimeoutError):
+        asyncio.run(llm.completion_with_backoff(5, model=MODEL, messages=[]))
+
+    # the 60s asked for are cut to the deadline, no call starts past it
+    assert time.monotonic() - start < 2
+    assert len(calls) == 1
@@ -0,0 +1,62 @@
+import pandas as pd
+
+from extractor.utils.normalize import normalize
+
+CHAVE = "35240111222333000181550010000001231000001238"
+
+
+def test_normalize():
+    df = pd.DataFrame(
+        {
+            "data": [
+                "2024-01-31",
+                "31/01/2024",
+                "[01/02/2024, 01/03/2024]",
+                "31/02/2024",
+            ],
+            "cnpj_do_vendedor": [
+                "11222333000181",
+                "11.222.333/0001-81",
+                "12345678901",
+                "11.222.333/0001-82",
+            ],
+            "chave_de_acesso": [CHAVE, None, "", "123"],
+            "valor": [10, "R$ 1.234,56", "1234.56", "abc"],
+            "num_nf": [1, "2", None, 1.5],
+        }
+    )
+    normalized = normalize(df)
+    frame, errors = normalized.frame, normalized.errors
+
+    assert frame["data"].tolist()[:3] == [
+        "2024-01-31",
+        "2024-01-31",
+        "[2024-02-01, 2024-03-01]",
+    ]
+    assert frame["cnpj_do_vendedor"].tolist()[:3] == [
+        "11.222.333/0001-81",
+        "11.222.333/0001-81",
+        "123.456.789-01",
+    ]
+    assert frame["valor"].tolist()[:3] == [10.0, 1234.56, 1234.56]
+    assert frame["num_nf"].tolist()[:2] == [1, 2]
+    assert pd.isna(frame["chave_de_acesso"][2])
+
+    assert not errors.iloc[:3].any(axis=None)
+    assert errors.iloc[3].all()
+    assert normalized.invalid.tolist() == [False, False, False, True]
+    assert normalized.invalid_required.tolist() == [False, False, False, True]
+
+
+def test_only_required_fields_make_a_row_invalid_required():
+    df = pd.DataFrame(
+        {
+            "data": ["2024-01-31"],
+            "valor": [10],
+            "chave_de_acesso": ["123"],
+            "num_nf": [1.5],
+        }
+    )
+    normalized = normalize(df)
+    assert normalized.invalid.tolist() == [True]
+    assert normalized.invalid_required.tolist() == [False]
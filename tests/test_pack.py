@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import openai
+import pytest
+
+from extractor import nfe
+from extractor.utils.cache import ExtractionCache
+from tests.conftest import ANSWER
+
+KNOWN = {"data": "2024-02-02", "valor": 20.0}
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch, offline_tokens):
+    """Answers every pack, with the CNPJ of the buyer for documents named `bad`."""
+    calls = []
+
+    async def acreate(**kwargs):
+        calls.append(kwargs)
+        content = kwargs["messages"][-1]["content"]
+        filepaths = [part.split()[0] for part in content.split("input_filepath: ")[1:]]
+        notas = [
+            {**ANSWER, "input_filepath": filepath}
+            for filepath in filepaths
+            if not filepath.startswith("bad")
+        ] + [
+            {
+                **ANSWER,
+                "input_filepath": filepath,
+                "cnpj_do_vendedor": "55.295.125/0001-88",
+            }
+            for filepath in filepaths
+            if filepath.startswith("bad")
+        ]
+        function_call = {
+            "name": kwargs["function_call"]["name"],
+            "arguments": json.dumps({"notas": notas}),
+        }
+        return {
+            "choices": [{"message": {"function_call": function_call}}],
+            "usage": {"total_tokens": 100},
+        }
+
+    async def process_nfe_document(document, input_filepath, *args, **kwargs):
+        calls.append(input_filepath)
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(nfe, "process_nfe_document", process_nfe_document)
+    monkeypatch.setattr(
+        nfe, "EXTRACTION_CACHE", ExtractionCache(str(tmp_path / "cache"), 1, 1)
+    )
+    return calls
+
+
+def test_pack_asks_for_the_missing_fields_and_caches(calls):
+    items = [("nota um", "a.txt", KNOWN), ("nota dois", "b.txt", KNOWN)]
+    results = asyncio.run(nfe.process_nfe_pack(items))
+
+    assert len(calls) == 1
+    fields = tuple(name for name in nfe.NfeCampos.model_fields if name not in KNOWN)
+    assert calls[0]["functions"] == [nfe.make_pack_schema(fields).openai_schema]
+    assert results["a.txt"].data == "2024-02-02"
+    assert results["b.txt"].fornecedor == "Papelaria"
+
+    # cached under the key `process_nfe_document` reads
+    schema = nfe.get_schema({**KNOWN, "input_filepath": "a.txt"})
+    assert nfe.lookup_extraction("nota um", schema, [calls[0]["model"]])
+
+    results = asyncio.run(nfe.process_nfe_pack(items))
+    assert len(calls) == 1
+    assert results["b.txt"].valor == 20.0
+
+
+def test_pack_asks_for_every_field_some_document_misses(calls):
+    items = [("nota um", "a.txt", KNOWN), ("nota dois", "b.txt", {})]
+    results = asyncio.run(nfe.process_nfe_pack(items))
+
+    assert calls[0]["functions"] == [nfe.NfeLote.openai_schema]
+    assert results["a.txt"].data == "2024-02-02"
+    assert results["b.txt"].data == "2024-01-01"
+
+
+def test_invalid_notas_are_extracted_alone(calls):
+    items = [("nota um", "a.txt", {}), ("nota ruim", "bad.txt", {})]
+    results = asyncio.run(nfe.process_nfe_pack(items))
+
+    assert calls[1:] == ["bad.txt"]
+    assert results["a.txt"] is not None
+    assert not nfe.lookup_extraction("nota ruim", nfe.NfeCampos, [calls[0]["model"]])
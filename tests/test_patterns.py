@@ -0,0 +1,36 @@
+from extractor.nfe import patterns
+
+CHAVE = "35240111222333000181550010000001231000001238"
+SPACED_CHAVE = " ".join(CHAVE[start : start + 4] for start in range(0, 44, 4))
+
+
+def test_pre_extract_reads_the_chave_valor_and_vencimento():
+    document = (
+        "DANFE\nCHAVE DE ACESSO\n"
+        f"{SPACED_CHAVE}\n"
+        "DESTINATARIO CNPJ 55.295.125/0001-88\n"
+        "VALOR TOTAL DA NOTA: R$ 1.234,56\n"
+        "FATURA VENCIMENTO: 10/02/2024\n"
+    )
+    assert patterns.pre_extract(document) == {
+        "chave_de_acesso": CHAVE,
+        "num_nf": 123,
+        "cnpj_do_vendedor": "11.222.333/0001-81",
+        "valor": 1234.56,
+        "data": "2024-02-10",
+    }
+
+
+def test_pre_extract_leaves_ambiguous_fields_to_the_model():
+    document = (
+        "CNPJ 11.222.333/0001-81 CNPJ 55.295.125/0001-88\n"
+        "VALOR TOTAL DA NOTA 10,00\nVALOR LIQUIDO 9,00\n"
+        "DATA DE EMISSAO 01/01/2024\nPARCELA 1 de 2\n"
+        "CHAVE 1234 5678 9012 3456 7890 1234 5678 9012 3456 7890 1234\n"
+    )
+    # the buyer CNPJ is ignored, an invalid chave is not one
+    assert patterns.pre_extract(document) == {"cnpj_do_vendedor": "11.222.333/0001-81"}
+
+
+def test_emission_date_when_nothing_is_due():
+    assert patterns.pre_extract("DATA DA EMISSÃO: 05/03/2024") == {"data": "2024-03-05"}
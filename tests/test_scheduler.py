@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from extractor.utils import scheduler
+from extractor.utils.scheduler import Scheduler
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = []
+
+    async def acquire(self, amount=1):
+        self.acquired.append(amount)
+
+
+def test_extra_calls_of_a_job_are_paced():
+    pool = Scheduler(max_workers=2, requests_per_minute=60, tokens_per_minute=6000)
+    pool.requests, pool.tokens = CountingLimiter(), CountingLimiter()
+
+    async def worker(calls):
+        # the first call is paid by the job cost, chunks run concurrently
+        await asyncio.gather(
+            *(scheduler.acquire_call(lambda: 50) for _ in range(calls))
+        )
+        return calls
+
+    async def run():
+        jobs = [(100, (1,)), (200, (3,))]
+        return [result async for result in pool.map(worker, jobs)]
+
+    assert sorted(asyncio.run(run())) == [1, 3]
+    # one request per job plus one per extra call
+    assert len(pool.requests.acquired) == 2 + 2
+    assert sorted(pool.tokens.acquired) == [50, 50, 100, 200]
+
+
+def test_calls_outside_a_job_are_not_paced():
+    def estimate():
+        raise AssertionError("not a scheduled call")
+
+    asyncio.run(scheduler.acquire_call(estimate))
+
+
+def test_cheapest_jobs_first_and_failures_yield_none():
+    pool = Scheduler(max_workers=1, requests_per_minute=6000, tokens_per_minute=1e9)
+    order = []
+
+    async def worker(name):
+        order.append(name)
+        if name == "fails":
+            raise ValueError(name)
+        return name
+
+    async def run():
+        jobs = [(300, ("large",)), (100, ("small",)), (200, ("fails",))]
+        return [result async for result in pool.map(worker, jobs)]
+
+    results = asyncio.run(run())
+    assert order == ["small", "fails", "large"]
+    assert results == ["small", None, "large"]
+
+
+def test_rate_limiter_paces_after_the_burst():
+    limiter = scheduler.RateLimiter(per_minute=600, headroom=1, burst=5)
+
+    async def run():
+        start = time.monotonic()
+        for _ in range(10):
+            await limiter.acquire()
+        return time.monotonic() - start
+
+    # 5 right away, 5 more at 10 per second
+    assert 0.45 <= asyncio.run(run()) < 1.5
+
+
+def test_rate_limiter_lets_an_oversized_request_drain_it():
+    limiter = scheduler.RateLimiter(per_minute=60, headroom=1)
+
+    async def run():
+        await asyncio.wait_for(limiter.acquire(1000), timeout=1)
+
+    asyncio.run(run())
+    assert limiter.tokens < 1
@@ -0,0 +1,35 @@
+import json
+
+import pytest
+
+from extractor.utils.streaming import ObjectStreamParser
+
+OBJECT = {
+    "data": "[2024-01-01, 2024-02-01]",
+    "fornecedor": 'Papelaria "Central", {Ltda}',
+    "valor": 1234.5,
+    "itens": [{"nome": "caneta"}, {"nome": "papel"}],
+    "chave_de_acesso": None,
+}
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 1000])
+def test_pairs_complete_as_they_arrive(size):
+    text = json.dumps(OBJECT, ensure_ascii=False)
+    parser = ObjectStreamParser()
+    pairs = []
+    for start in range(0, len(text), size):
+        pairs += parser.feed(text[start : start + size])
+    assert pairs == list(OBJECT.items())
+
+
+def test_pair_returned_before_the_object_ends():
+    parser = ObjectStreamParser()
+    assert parser.feed('{"valor": 10.5, "forn') == [("valor", 10.5)]
+    assert parser.feed('ecedor": "X"}') == [("fornecedor", "X")]
+
+
+def test_invalid_pair_raises():
+    parser = ObjectStreamParser()
+    with pytest.raises(ValueError):
+        parser.feed('{"valor": 10,5, ')
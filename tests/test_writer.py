@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from extractor.airtable.mirror import AirtableMirror
+from extractor.airtable.writer import BatchWriter
+
+MERGE_ON = ["chave_de_acesso"]
+
+
+class StubTable:
+    """`batch_upsert` of a pyairtable Table, failing the calls listed in `fail`."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def batch_upsert(self, records, key_fields):
+        with self._lock:
+            call = len(self.calls)
+            self.calls.append((time.monotonic(), records, key_fields))
+        if call in self.fail:
+            raise RuntimeError("422 Client Error")
+        return {
+            "records": [
+                {"id": f"rec{record['fields']['chave_de_acesso']}", **record}
+                for record in records
+            ]
+        }
+
+
+def make_records(count, **fields):
+    return {
+        f"key{i}": {"chave_de_acesso": str(i), "valor": 10.0 + i, **fields}
+        for i in range(count)
+    }
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    with AirtableMirror(str(tmp_path / "airtable.sqlite")) as mirror:
+        yield mirror
+
+
+def test_writes_batches_of_ten(mirror):
+    table = StubTable()
+    writer = BatchWriter(table, "Despesas", mirror, requests_per_second=100)
+
+    assert asyncio.run(writer.write(make_records(25), MERGE_ON)) == 25
+    assert sorted(len(records) for _, records, _ in table.calls) == [5, 10, 10]
+    assert all(key_fields == MERGE_ON for _, _, key_fields in table.calls)
+    assert len(mirror.written_hashes("Despesas")) == 25
+    assert len(mirror) == 25
+
+
+def test_resumes_from_the_checkpoint(mirror):
+    records = make_records(30)
+    table = StubTable(fail={1})
+    writer = BatchWriter(
+        table, "Despesas", mirror, requests_per_second=100, max_in_flight=1
+    )
+    assert asyncio.run(writer.write(records, MERGE_ON)) == 20
+
+    table = StubTable()
+    writer = BatchWriter(table, "Despesas", mirror, requests_per_second=100)
+    assert asyncio.run(writer.write(records, MERGE_ON)) == 10
+    assert len(table.calls) == 1
+
+    # only changed records are written again, ignored fields never change them
+    assert writer.pending(records) == []
+    changed = {**records, "key0": {**records["key0"], "valor": 1.0}}
+    assert writer.pending(changed) == ["key0"]
+    writer = BatchWriter(
+        table, "Despesas", mirror, requests_per_second=100, ignore_fields=["link"]
+    )
+    with_links = {key: {**record, "link": "x"} for key, record in records.items()}
+    assert writer.pending(with_links) == []
+
+
+def test_paces_requests_per_second(mirror):
+    table = StubTable()
+    writer = BatchWriter(
+        table, "Despesas", mirror, requests_per_second=20, max_in_flight=8
+    )
+    start = time.monotonic()
+    asyncio.run(writer.write(make_records(300), MERGE_ON))
+
+    # a burst of 20 requests, then 20 per second
+    assert len(table.calls) == 30
+    assert time.monotonic() - start >= 0.45
+    started = sorted(started_at for started_at, _, _ in table.calls)
+    assert started[-1] - started[20] >= 0.4
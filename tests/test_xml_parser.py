@@ -0,0 +1,88 @@
+from extractor import nfe
+from extractor.nfe import xml_parser
+
+CHAVE = "35240111222333000181550010000001231000001238"
+
+NFE = f"""<?xml version="1.0" encoding="UTF-8"?>
+<nfeProc xmlns="http://www.portalfiscal.inf.br/nfe">
+  <NFe><infNFe Id="NFe{CHAVE}">
+    <ide><nNF>123</nNF><dhEmi>2024-01-05T10:00:00-03:00</dhEmi></ide>
+    <emit><CNPJ>11222333000181</CNPJ><xNome>Papelaria Central</xNome></emit>
+    <det><prod><xProd>Caneta</xProd></prod></det>
+    <det><prod><xProd>Papel A4</xProd></prod></det>
+    <total><ICMSTot><vNF>1234.56</vNF></ICMSTot></total>
+    <cobr>
+      <dup><dVenc>2024-02-05</dVenc></dup>
+      <dup><dVenc>2024-03-05</dVenc></dup>
+    </cobr>
+    <pag><detPag><tPag>15</tPag></detPag><detPag><tPag>15</tPag></detPag></pag>
+  </infNFe></NFe>
+</nfeProc>"""
+
+NFSE = """<?xml version="1.0" encoding="UTF-8"?>
+<CompNfse xmlns="http://www.abrasf.org.br/nfse.xsd"><Nfse><InfNfse>
+  <Numero>29</Numero>
+  <DataEmissao>2023-10-24T11:44:51</DataEmissao>
+  <Servico>
+    <Valores><ValorServicos>1790</ValorServicos><ValorLiquidoNfse>1700.5</ValorLiquidoNfse></Valores>
+    <Discriminacao>Manutencao de jardim</Discriminacao>
+  </Servico>
+  <PrestadorServico>
+    <IdentificacaoPrestador><CpfCnpj><Cnpj>11222333000181</Cnpj></CpfCnpj></IdentificacaoPrestador>
+    <RazaoSocial>Jardins Ltda</RazaoSocial>
+  </PrestadorServico>
+</InfNfse></Nfse></CompNfse>"""
+
+
+def test_nfe():
+    extraction = xml_parser.parse_xml(NFE)
+    assert extraction.fields == {
+        "num_nf": 123,
+        "valor": 1234.56,
+        "fornecedor": "Papelaria Central",
+        "cnpj_do_vendedor": "11.222.333/0001-81",
+        "chave_de_acesso": CHAVE,
+        "data": "[2024-02-05, 2024-03-05]",
+        "numero_de_parcelas": 2,
+        "forma": "BOLETO",
+    }
+    assert extraction.descriptions == ["Caneta", "Papel A4"]
+
+
+def test_nfse():
+    extraction = xml_parser.parse_xml(NFSE)
+    assert extraction.fields == {
+        "num_nf": 29,
+        "valor": 1700.5,
+        "fornecedor": "Jardins Ltda",
+        "cnpj_do_vendedor": "11.222.333/0001-81",
+        "data": "2023-10-24",
+    }
+    assert extraction.descriptions == ["Manutencao de jardim"]
+
+
+# São Paulo NFS-e, a layout NFE_PATHS does not map
+NFSE_SP = """<?xml version="1.0" encoding="UTF-8"?>
+<RetornoConsulta xmlns="http://www.prefeitura.sp.gov.br/nfe"><NFe>
+  <ChaveNFe><InscricaoPrestador>12345678</InscricaoPrestador><NumeroNFe>4567</NumeroNFe></ChaveNFe>
+  <DataEmissaoNFe>2024-01-05T10:00:00</DataEmissaoNFe>
+  <CPFCNPJPrestador><CNPJ>11222333000181</CNPJ></CPFCNPJPrestador>
+  <RazaoSocialPrestador>Jardins Ltda</RazaoSocialPrestador>
+  <ValorServicos>100.00</ValorServicos>
+</NFe></RetornoConsulta>"""
+
+
+def test_known_layouts_leave_missing_optional_fields_empty():
+    _, fields = nfe.prepare_xml_document(NFSE)
+    assert fields["chave_de_acesso"] is None
+    assert fields["forma"] is None
+    assert fields["num_nf"] == 29
+
+
+def test_unknown_layouts_leave_optional_fields_to_the_model():
+    document, fields = nfe.prepare_xml_document(NFSE_SP)
+    assert document == NFSE_SP
+    assert not {"num_nf", "chave_de_acesso", "forma"} & fields.keys()
+    assert (
+        "num_nf" in nfe.get_schema({**fields, "input_filepath": "sp.xml"}).model_fields
+    )